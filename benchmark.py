@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+# Benchmarks for the interpreter.  Run as `python benchmark.py name`,
+# or with no name to run all of them.
+
+import gc
+import os
+import sys
+import time
+import struct
+import tempfile
+import parser
+import superinst
+from opcodes import OPCODES
+from interpreter import Interpreter
+from luatypes import LuaTable, LuaValue
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test')
+
+def timeit(f, repeat=3):
+    """ Returns the best time in seconds out of repeat calls of f. """
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def make_chunk(num_instructions):
+    """ Builds a little endian Lua 5.1 chunk whose top level function
+    loads a constant num_instructions times, with a string constant for
+    every fourth instruction and full line info, to stand in for a large
+    luac generated chunk.
+    """
+    num_constants = max(1, num_instructions / 4)
+    header = '\x1bLua\x51\x00\x01\x04\x04\x04\x08\x00'
+    sourcename = '=benchmark\0'
+    parts = [header, struct.pack('<i', len(sourcename)), sourcename,
+             struct.pack('<iiBBBB', 0, 0, 0, 0, 2, 2)]
+    # LOADK 0 k, then RETURN 0 1
+    instructions = [1 | ((i % num_constants) << 14)
+                    for i in xrange(num_instructions)]
+    instructions.append(30 | (1 << 23))
+    parts.append(struct.pack('<i', len(instructions)))
+    parts.append(struct.pack('<%dI' % len(instructions), *instructions))
+    parts.append(struct.pack('<i', num_constants))
+    for k in xrange(num_constants):
+        value = 'constant%d\0' % k
+        parts.append('\x04' + struct.pack('<i', len(value)) + value)
+    parts.append(struct.pack('<i', 0)) # prototypes
+    parts.append(struct.pack('<i', len(instructions)))
+    parts.append(struct.pack('<%di' % len(instructions),
+                             *xrange(1, len(instructions) + 1)))
+    parts.append(struct.pack('<ii', 0, 0)) # locals, upvalues
+    return ''.join(parts)
+
+def read_in_blocks(filename):
+    """ How the entry points used to read files, for comparison. """
+    bcfile = os.open(filename, os.O_RDONLY, 0777)
+    bytecode = ""
+    while True:
+        read = os.read(bcfile, 4096)
+        if len(read) == 0:
+            break
+        bytecode += read
+    os.close(bcfile)
+    return bytecode
+
+def bench_load():
+    """ Time to read chunks of growing size in 4096 byte blocks and with
+    read_file, and to load and parse them with load_file.  The time per
+    KB should stay flat as the chunks grow.
+    """
+    print '%10s %12s %12s %12s %12s' % ('bytes', 'blocks', 'read_file',
+                                        'load_file', 'us/KB')
+    for num_instructions in [2 ** n for n in xrange(12, 20)]:
+        chunk = make_chunk(num_instructions)
+        fd, filename = tempfile.mkstemp(suffix='.luac')
+        try:
+            os.write(fd, chunk)
+            os.close(fd)
+            blocks = timeit(lambda: read_in_blocks(filename))
+            read = timeit(lambda: parser.read_file(filename))
+            load = timeit(lambda: parser.load_file(filename))
+        finally:
+            os.remove(filename)
+        print '%10d %12.4f %12.4f %12.4f %12.2f' % (
+            len(chunk), blocks, read, load, load * 1e6 / (len(chunk) / 1024.0))
+
+def luac_file(name):
+    """ Returns the luac file for the lua script test/name, compiling it
+    with luac first if it has not been yet.
+    """
+    filename = os.path.join(TEST_DIR, name)
+    if not os.path.exists(filename + 'c'):
+        parser.compile_lua(filename)
+    return filename + 'c'
+
+def run_script(name, args=[], **options):
+    """ Runs test/name with the interpreter, with its output thrown away.
+    options are passed on to Interpreter.
+    """
+    filename = luac_file(name)
+    interpreter = Interpreter(parser.load_file(filename), [filename] + args,
+                              **options)
+    # redirect at the file descriptor level, as io.write holds on to
+    # the original sys.stdout
+    sys.stdout.flush()
+    stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        interpreter.run()
+    finally:
+        sys.stdout.flush()
+        os.dup2(stdout, 1)
+        os.close(stdout)
+        os.close(devnull)
+
+def time_script(name, args=[], repeat=1, **options):
+    """ Returns the time run_script takes, or the error it failed with
+    if the script doesn't run on this interpreter yet.
+    """
+    try:
+        return timeit(lambda: run_script(name, args, **options), repeat)
+    except Exception, e:
+        return '%s: %s' % (type(e).__name__, e)
+
+# scripts from test/ with their arguments, for benchmarks that run them
+SCRIPTS = [('fib.lua', ['20']), ('bisect.lua', []), ('sort.lua', []),
+           ('life.lua', []), ('sieve.lua', [])]
+
+def format_time(t):
+    return '%.3fs' % t if isinstance(t, float) else 'fails (%s)' % t
+
+def bench_checked():
+    """ Running scripts with and without --checked, which checks the
+    interpreter's state after every instruction.
+    """
+    for name, args in SCRIPTS:
+        fast = time_script(name, args)
+        checked = time_script(name, args, checked=True)
+        ratio = ''
+        if isinstance(fast, float) and isinstance(checked, float):
+            ratio = '  (%.1fx)' % (checked / fast)
+        print '%-12s fast %s  checked %s%s' % (
+            name, format_time(fast), format_time(checked), ratio)
+
+def compare(options, scripts=SCRIPTS, repeat=3):
+    """ Prints how long each script takes with the interpreter's defaults
+    and with the given options.
+    """
+    for name, args in scripts:
+        default = time_script(name, args, repeat)
+        timed = time_script(name, args, repeat, **options)
+        ratio = ''
+        if isinstance(default, float) and isinstance(timed, float):
+            ratio = '  (speedup %.1fx)' % (default / timed)
+        print '%-12s default %s  %s %s%s' % (
+            name, format_time(default),
+            ' '.join(sorted(options)), format_time(timed), ratio)
+
+def bench_compile():
+    """ Running scripts with the interpreter and with the compiled tier. """
+    compare({'compile': True})
+
+def bench_quicken():
+    """ Running scripts with and without quickening of arithmetic and
+    compare instructions.
+    """
+    for name, args in SCRIPTS:
+        generic = time_script(name, args, 3, adaptive=False)
+        quickened = time_script(name, args, 3)
+        ratio = ''
+        if isinstance(generic, float) and isinstance(quickened, float):
+            ratio = '  (speedup %.1fx)' % (generic / quickened)
+        print '%-12s generic %s  quickened %s%s' % (
+            name, format_time(generic), format_time(quickened), ratio)
+
+class PairCounter(Interpreter):
+    """ An interpreter that counts how often each pair of opcodes runs one
+    straight after the other, in the same frame.
+    """
+    def __init__(self, lua_object, arg, counts):
+        Interpreter.__init__(self, lua_object, arg)
+        self.counts = counts
+        self.op_functions = [self.counted(opcode) for opcode
+                             in xrange(len(self.op_functions))]
+        self.last = None
+
+    def counted(self, opcode):
+        handler = self.op_functions[opcode]
+        def counted_handler(inst):
+            last = self.last
+            if (last is not None and last[1] == self.pc - 1 and
+                last[2] == self.depth):
+                pair = (last[0], opcode)
+                self.counts[pair] = self.counts.get(pair, 0) + 1
+            self.last = (opcode, self.pc, self.depth)
+            handler(inst)
+        return counted_handler
+
+def bench_pairs():
+    """ The pairs of opcodes that run one after the other most often in
+    the scripts, which are the candidates for superinstructions.
+    """
+    counts = {}
+    for name, args in SCRIPTS:
+        filename = luac_file(name)
+        interpreter = PairCounter(parser.load_file(filename),
+                                  [filename] + args, counts)
+        sys.stdout.flush()
+        stdout = os.dup(1)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        try:
+            interpreter.run()
+        except Exception:
+            pass
+        finally:
+            sys.stdout.flush()
+            os.dup2(stdout, 1)
+            os.close(stdout)
+            os.close(devnull)
+    total = sum(counts.values())
+    ranked = sorted(counts.items(), key=lambda (pair, n): -n)
+    for (first, second), n in ranked[:25]:
+        print '%-10s %-10s %6.2f%%' % (OPCODES[first][0], OPCODES[second][0],
+                                       100.0 * n / total)
+
+def bench_fuse():
+    """ Running scripts with and without superinstructions. """
+    compare({'fuse': superinst.DEFAULT_PAIRS})
+
+def footprint(objects):
+    """ Returns the bytes taken by objects, the parts each one holds and
+    the values in those parts, counting every object once, so that
+    objects they share, such as shapes, keys and empty parts, add next
+    to nothing.
+    """
+    seen = set()
+    sizes = []
+    def count(obj):
+        if id(obj) in seen or isinstance(obj, type):
+            return False
+        seen.add(id(obj))
+        sizes.append(sys.getsizeof(obj))
+        return True
+    for obj in objects:
+        count(obj)
+        for part in gc.get_referents(obj):
+            if count(part) and type(part) in (list, tuple, dict):
+                for value in gc.get_referents(part):
+                    count(value)
+    return sum(sizes)
+
+def make_array():
+    table = LuaTable()
+    for i in xrange(1, 11):
+        table.set(i, float(i))
+    return table
+
+def make_record():
+    table = LuaTable()
+    for i in xrange(10):
+        table.set('field%d' % i, float(i))
+    return table
+
+def bench_memory():
+    """ Bytes each table and upvalue takes, on average over many of them.
+    """
+    count = 10000
+    for name, make in [('empty table', LuaTable),
+                       ('10 element array', make_array),
+                       ('10 field record', make_record),
+                       ('upvalue', lambda: LuaValue(None))]:
+        objects = [make() for _ in xrange(count)]
+        print '%-18s %8.1f bytes' % (name, footprint(objects) / float(count))
+
+benchmarks = {
+    'checked': bench_checked,
+    'compile': bench_compile,
+    'fuse': bench_fuse,
+    'load': bench_load,
+    'memory': bench_memory,
+    'pairs': bench_pairs,
+    'quicken': bench_quicken,
+    }
+
+def main(argv):
+    names = argv[1:] or sorted(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            print 'usage: benchmark.py [%s]' % '|'.join(sorted(benchmarks))
+            return 1
+        print '=== %s ===' % name
+        benchmarks[name]()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
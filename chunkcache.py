@@ -0,0 +1,224 @@
+# chunkcache: on-disk cache of parsed lua chunks, so that starting the
+# interpreter on a script it has already seen skips running luac and
+# parsing the bytecode.
+
+import os
+import sys
+import marshal
+import hashlib
+import tempfile
+import parser
+
+# bump whenever the layout written by dump_function changes
+CACHE_FORMAT = 1
+CACHE_MAGIC = 'SOAMC%d\n' % CACHE_FORMAT
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024 # bytes
+
+def default_directory():
+    """ The cache directory, $SOAM_CACHE_DIR or ~/.cache/soam """
+    directory = os.environ.get('SOAM_CACHE_DIR')
+    if not directory:
+        directory = os.path.join(os.path.expanduser('~'), '.cache', 'soam')
+    return directory
+
+def dump_function(function):
+    """ Flattens a LuaFunction and all of its prototypes into nested
+    tuples of plain values that marshal can write.
+    """
+    return (function.sourcename, function.line_defined,
+            function.last_line_defined, function.num_upvalues,
+            function.num_parameters, function.is_vararg_flag,
+            function.max_stack_size, function.instructions,
+            [k.value for k in function.constants],
+            [dump_function(function.get_prototype(i))
+             for i in xrange(len(function.prototypes))],
+            function.inst_positions, function.locvars, function.upvalues)
+
+def load_function(data):
+    """ Rebuilds a LuaFunction from the tuples made by dump_function. """
+    (sourcename, line_defined, last_line_defined, num_upvalues,
+     num_parameters, is_vararg_flag, max_stack_size, instructions,
+     values, prototypes, inst_positions, locvars, upvalues) = data
+    constants = []
+    for value in values:
+        if value is None:
+            constants.append(parser.LuaNil())
+        elif isinstance(value, bool):
+            constants.append(parser.LuaBoolean(value))
+        elif isinstance(value, str):
+            constants.append(parser.LuaString(value))
+        else:
+            constants.append(parser.LuaNumber(value))
+    return parser.LuaFunction(sourcename, line_defined, last_line_defined,
+                              num_upvalues, num_parameters, is_vararg_flag,
+                              max_stack_size, instructions, constants,
+                              [load_function(p) for p in prototypes],
+                              inst_positions, locvars, upvalues)
+
+class CachedBytecode:
+    """ Stands in for a LuaBytecode whose header and top level function
+    were loaded from the cache instead of parsed.
+    """
+    def __init__(self, header, top_level_func):
+        self.header = header
+        self.top_level_func = top_level_func
+
+class ChunkCache:
+    """ A directory of parsed chunks, each in a file named after the
+    SHA-1 of the lua source or luac bytecode it was made from.  When the
+    files add up to more than max_size bytes, the least recently used
+    ones are removed.  Hit, miss, store and eviction counts for this
+    process are kept in stats.
+    """
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    def key(self, filename, data):
+        kind = 'lua' if filename.endswith('.lua') else 'luac'
+        return hashlib.sha1(kind + '\0' + data).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.soamc')
+
+    def load(self, filename):
+        """ Returns the parsed chunk for the lua or luac file at filename
+        (or the luac bytecode on stdin, if it is '-'), from the cache if
+        it has it, otherwise by compiling and parsing it and storing the
+        result.
+        """
+        data = parser.read_file(filename)
+        key = self.key(filename, data)
+        lua_bytecode = self.get(key)
+        if lua_bytecode is not None:
+            return lua_bytecode
+        if filename.endswith('.lua'):
+            data = parser.compile_lua(filename)
+        lua_bytecode = parser.LuaBytecode(data)
+        self.put(key, lua_bytecode)
+        return lua_bytecode
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.stats['misses'] += 1
+            return None
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        lua_bytecode = None
+        if data.startswith(CACHE_MAGIC):
+            try:
+                header, top_level_func = marshal.loads(
+                    data[len(CACHE_MAGIC):])
+                lua_bytecode = CachedBytecode(parser.LuaHeader(*header),
+                                              load_function(top_level_func))
+            except (ValueError, EOFError, TypeError):
+                # a truncated or corrupt entry
+                pass
+        if lua_bytecode is None:
+            # so that it gets parsed and stored again
+            self.stats['misses'] += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            # mark as recently used for eviction
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.stats['hits'] += 1
+        return lua_bytecode
+
+    def put(self, key, lua_bytecode):
+        h = lua_bytecode.header
+        header = (h.signature, h.version, h.format_version, h.endianness,
+                  h.size_of_int, h.size_of_size_t, h.size_of_instruction,
+                  h.size_of_lua_Number, h.integral_flag)
+        data = CACHE_MAGIC + marshal.dumps(
+            (header, dump_function(lua_bytecode.top_level_func)))
+        try:
+            self.write(key, data)
+        except (OSError, IOError):
+            # the chunk was already counted as a miss by get, and is
+            # just parsed again next time
+            return
+        self.stats['stores'] += 1
+        self.evict()
+
+    def write(self, key, data):
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            # another interpreter may have just made it
+            if not os.path.isdir(self.directory):
+                raise
+        # write to a temporary file and rename it into place, so other
+        # interpreters never read a partly written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            try:
+                written = 0
+                while written < len(data):
+                    written += os.write(fd, buffer(data, written))
+                # mkstemp makes it readable by its owner only, but the
+                # cache may be shared
+                umask = os.umask(0)
+                os.umask(umask)
+                os.fchmod(fd, 0644 & ~umask)
+            finally:
+                os.close(fd)
+            os.rename(tmp_path, self.path(key))
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def entries(self):
+        """ Returns a list of (mtime, size, path) for each cached chunk. """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.soamc'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        """ Removes the least recently used chunks until the cache is
+        within max_size.
+        """
+        entries = self.entries()
+        total = sum([size for (_, size, _) in entries])
+        entries.sort()
+        for (_, size, path) in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.stats['evictions'] += 1
+
+    def print_stats(self, out=sys.stderr):
+        entries = self.entries() if os.path.isdir(self.directory) else []
+        out.write('cache %s: %d entries, %d/%d bytes, %d hits, %d misses, '
+                  '%d stores, %d evictions\n' % (
+                self.directory, len(entries),
+                sum([size for (_, size, _) in entries]), self.max_size,
+                self.stats['hits'], self.stats['misses'],
+                self.stats['stores'], self.stats['evictions']))
@@ -0,0 +1,387 @@
+# codegen: translates the instructions of a lua function into Python
+# source, which is compiled once and kept on the LuaFunction.  Used by
+# the interpreter's compiled tier (--compile).
+#
+# The generated function runs the frame the interpreter is currently in,
+# starting at its pc, with the operands of each instruction baked into
+# the code.  The instructions are split into basic blocks, and jumps
+# between blocks go through a binary search on pc inside a while loop.
+# Instructions that don't gain much from being inlined are run by the
+# interpreter's own handler.  The function returns as soon as the frame
+# changes (a lua function was called, or this one returned), with the
+# interpreter's pc set as if its main loop had run that instruction.
+
+from opcodes import *
+from luatypes import LuaTable
+import superinst
+
+ARITH_OPERATORS = {ADD: '+', SUB: '-', MUL: '*', DIV: '/', MOD: '%',
+                   POW: '**'}
+COMPARE_OPERATORS = {EQ: '==', LT: '<', LE: '<='}
+# the metamethod events of the operators
+ARITH_EVENTS = {ADD: '__add', SUB: '__sub', MUL: '__mul', DIV: '__div',
+                MOD: '__mod', POW: '__pow'}
+# the interpreter's methods that compare tables
+COMPARE_METHODS = {EQ: 'equal', LT: 'less_than', LE: 'less_equal'}
+
+# run by their handler, and the frame may change under them
+FRAME_CHANGING = (CALL,)
+# run by their handler, and the frame always changes
+FRAME_LEAVING = (TAILCALL, RETURN)
+# run by their handler, and neither change the frame nor look at pc
+HANDLED = (NEWTABLE, SETUPVAL, CLOSE, VARARG)
+
+class FunctionCompiler:
+    """ Generates the Python source for one LuaFunction.  decoder is the
+    interpreter, whose getabc, getabx and getasbx are used so that
+    operands are decoded exactly the way the interpreter decodes them.
+    """
+    def __init__(self, function, decoder):
+        self.function = function
+        # superinstructions are generated as the instructions they stand for
+        self.instructions = [superinst.unfuse(inst)
+                             for inst in function.instructions]
+        self.decoder = decoder
+        self.lines = []
+        self.constants_used = set()
+
+    def next_pc(self, pc):
+        """ The pc of the instruction after the one at pc, skipping the
+        words that follow CLOSURE and SETLIST that aren't instructions.
+        """
+        inst = self.instructions[pc]
+        opcode = inst & 0x0000003f
+        if opcode == CLOSURE:
+            _, bx = self.decoder.getabx(inst)
+            return pc + 1 + self.function.get_num_upvalues(bx)
+        if opcode == SETLIST:
+            _, _, c = self.decoder.getabc(inst)
+            if c == 0:
+                return pc + 2
+        return pc + 1
+
+    def find_leaders(self):
+        """ Returns the sorted pcs that start a basic block: the first
+        instruction, targets of jumps and skips, and the instructions
+        after ones that end a block.
+        """
+        leaders = set([0])
+        n = len(self.instructions)
+        pc = 0
+        while pc < n:
+            inst = self.instructions[pc]
+            opcode = inst & 0x0000003f
+            next_pc = self.next_pc(pc)
+            if opcode in (JMP, FORLOOP, FORPREP):
+                _, sbx = self.decoder.getasbx(inst)
+                leaders.add(pc + 1 + sbx)
+                leaders.add(next_pc)
+            elif opcode in (EQ, LT, LE, TEST, TESTSET, TFORLOOP):
+                leaders.add(pc + 2)
+            elif opcode == LOADBOOL:
+                _, _, c = self.decoder.getabc(inst)
+                if c:
+                    leaders.add(pc + 2)
+                    leaders.add(next_pc)
+            elif opcode in FRAME_CHANGING:
+                leaders.add(next_pc)
+                leaders.add(pc + 2)
+            elif opcode in FRAME_LEAVING:
+                leaders.add(next_pc)
+            pc = next_pc
+        return sorted([l for l in leaders if 0 <= l < n])
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def k(self, index):
+        self.constants_used.add(index)
+        return 'k%d' % index
+
+    def rk(self, o):
+        if o & 256:
+            return self.k(o - 256)
+        return 'S[B+%d]' % o
+
+    def goto(self, indent, pc):
+        self.emit(indent, 'pc = %s' % pc)
+        self.emit(indent, 'continue')
+
+    def emit_handler(self, indent, pc, inst):
+        self.emit(indent, 'self.pc = %d' % pc)
+        self.emit(indent, 'OPS[%d](%d)' % (inst & 0x0000003f, inst))
+
+    def emit_call(self, indent, pc, line):
+        # a call into the interpreter, which looks at pc for its caches,
+        # for the frame of a metamethod, and to say where an error was
+        self.emit(indent, 'self.pc = %d' % pc)
+        self.emit(indent, line)
+
+    def emit_global_cache(self, indent, pc, bx):
+        # the interpreter's cache of the global's slot, see
+        # Interpreter.global_cache
+        self.emit(indent, 'if GV[%d] != G.version:' % pc)
+        self.emit(indent + 1, 'self.cache_global(F, %d, %d)' % (pc, bx))
+
+    def emit_block(self, indent, start, end):
+        """ Emits the instructions from start up to the block at end, and
+        returns whether control can fall off the end of them.
+        """
+        pc = start
+        while pc < end:
+            inst = self.instructions[pc]
+            opcode = inst & 0x0000003f
+            a, b, c = self.decoder.getabc(inst)
+            next_pc = self.next_pc(pc)
+            if opcode == MOVE:
+                self.emit(indent, 'S[B+%d] = S[B+%d]' % (a, b))
+            elif opcode == LOADK:
+                a, bx = self.decoder.getabx(inst)
+                self.emit(indent, 'S[B+%d] = %s' % (a, self.k(bx)))
+            elif opcode == LOADBOOL:
+                self.emit(indent, 'S[B+%d] = %s' % (a, bool(b)))
+                if c:
+                    self.goto(indent, pc + 2)
+                    return False
+            elif opcode == LOADNIL:
+                for i in xrange(a, b+1):
+                    self.emit(indent, 'S[B+%d] = None' % i)
+            elif opcode == GETUPVAL:
+                self.emit(indent, 'v = U[%d]' % b)
+                self.emit(indent, 'S[B+%d] = v.value if v.index < 0 '
+                          'else S[v.index]' % a)
+            elif opcode == GETGLOBAL:
+                a, bx = self.decoder.getabx(inst)
+                self.emit_global_cache(indent, pc, bx)
+                self.emit(indent, 'v = V[GS[%d]]' % pc)
+                self.emit(indent, 'if v is None and G.metatable is not None:')
+                self.emit_call(indent + 1, pc,
+                               'v = self.index_constant(F, %d, G, %s)'
+                               % (pc, self.k(bx)))
+                self.emit(indent, 'S[B+%d] = v' % a)
+            elif opcode == GETTABLE and c & 256:
+                self.emit(indent, 't = S[B+%d]' % b)
+                self.emit(indent, 'if type(t) is LuaTable and '
+                          't.shape is TS[%d]:' % pc)
+                self.emit(indent + 1, 'v = t.fields[TL[%d]]' % pc)
+                self.emit(indent, 'else:')
+                self.emit(indent + 1, 'v = None')
+                self.emit(indent, 'if v is None:')
+                self.emit_call(indent + 1, pc,
+                               'v = self.index_constant(F, %d, t, %s)'
+                               % (pc, self.rk(c)))
+                self.emit(indent, 'S[B+%d] = v' % a)
+            elif opcode == GETTABLE:
+                self.emit(indent, 't = S[B+%d]' % b)
+                self.emit(indent, 'if type(t) is LuaTable and '
+                          't.metatable is None:')
+                self.emit(indent + 1, 'S[B+%d] = t.get(%s)' % (a, self.rk(c)))
+                self.emit(indent, 'else:')
+                self.emit_call(indent + 1, pc,
+                               'S[B+%d] = self.index(t, %s)' % (a, self.rk(c)))
+            elif opcode == SETGLOBAL:
+                a, bx = self.decoder.getabx(inst)
+                self.emit_global_cache(indent, pc, bx)
+                self.emit(indent, 'if GS[%d] and (G.metatable is None or '
+                          'V[GS[%d]] is not None):' % (pc, pc))
+                self.emit(indent + 1, 'V[GS[%d]] = S[B+%d]' % (pc, a))
+                self.emit(indent, 'elif G.metatable is None:')
+                self.emit(indent + 1, 'G.set(%s, S[B+%d])' % (self.k(bx), a))
+                self.emit(indent, 'else:')
+                self.emit_call(indent + 1, pc,
+                               'self.newindex_constant(F, %d, G, %s, S[B+%d])'
+                               % (pc, self.k(bx), a))
+            elif opcode == SETTABLE and b & 256:
+                # as Interpreter.settable
+                self.emit(indent, 't = S[B+%d]' % a)
+                self.emit(indent, 'if (type(t) is LuaTable and '
+                          't.shape is TS[%d] and' % pc)
+                self.emit(indent, '    (t.metatable is None or TN[%d] is None '
+                          'and t.fields[TL[%d]] is not None)):' % (pc, pc))
+                self.emit(indent + 1, 'if TN[%d] is None:' % pc)
+                self.emit(indent + 2, 't.fields[TL[%d]] = %s' % (
+                        pc, self.rk(c)))
+                self.emit(indent + 1, 'else:')
+                self.emit(indent + 2, 't.shape = TN[%d]' % pc)
+                self.emit(indent + 2, 't.add_field(%s)' % self.rk(c))
+                self.emit(indent, 'else:')
+                self.emit_call(indent + 1, pc,
+                               'self.newindex_constant(F, %d, t, %s, %s)'
+                               % (pc, self.rk(b), self.rk(c)))
+            elif opcode == SETTABLE:
+                self.emit(indent, 't = S[B+%d]' % a)
+                self.emit(indent, 'if type(t) is LuaTable and '
+                          't.metatable is None:')
+                self.emit(indent + 1, 't.set(%s, %s)' % (
+                        self.rk(b), self.rk(c)))
+                self.emit(indent, 'else:')
+                self.emit_call(indent + 1, pc, 'self.newindex(t, %s, %s)' % (
+                        self.rk(b), self.rk(c)))
+            elif opcode in ARITH_OPERATORS:
+                # operands that aren't numbers go to their metamethods
+                self.emit(indent, 'try:')
+                self.emit(indent + 1, 'S[B+%d] = %s %s %s' % (
+                        a, self.rk(b), ARITH_OPERATORS[opcode], self.rk(c)))
+                self.emit(indent, 'except TypeError:')
+                self.emit_call(indent + 1, pc,
+                               "S[B+%d] = self.arith('%s', %s, %s)" % (
+                        a, ARITH_EVENTS[opcode], self.rk(b), self.rk(c)))
+            elif opcode == UNM:
+                self.emit(indent, 'try:')
+                self.emit(indent + 1, 'S[B+%d] = -S[B+%d]' % (a, b))
+                self.emit(indent, 'except TypeError:')
+                self.emit_call(indent + 1, pc,
+                               "S[B+%d] = self.arith('__unm', S[B+%d], "
+                               "S[B+%d])" % (a, b, b))
+            elif opcode == NOT:
+                self.emit(indent, 'S[B+%d] = not S[B+%d]' % (a, b))
+            elif opcode == LEN:
+                self.emit(indent, 'v = S[B+%d]' % b)
+                self.emit(indent, 'if type(v) is LuaTable:')
+                self.emit(indent + 1, 'S[B+%d] = v.length()' % a)
+                self.emit(indent, 'else:')
+                self.emit(indent + 1, 'S[B+%d] = len(v)' % a)
+            elif opcode == CONCAT:
+                self.emit(indent, "S[B+%d] = ''.join([%s])" % (
+                        a, ', '.join(['S[B+%d]' % i
+                                      for i in xrange(b, c+1)])))
+            elif opcode == JMP:
+                _, sbx = self.decoder.getasbx(inst)
+                self.goto(indent, pc + 1 + sbx)
+                return False
+            elif opcode in COMPARE_OPERATORS:
+                # tables are compared by their metamethods
+                self.emit(indent, 'v = %s' % self.rk(b))
+                self.emit(indent, 'if type(v) is LuaTable:')
+                self.emit_call(indent + 1, pc, 'v = self.%s(v, %s)' % (
+                        COMPARE_METHODS[opcode], self.rk(c)))
+                self.emit(indent, 'else:')
+                self.emit(indent + 1, 'v = v %s %s' % (
+                        COMPARE_OPERATORS[opcode], self.rk(c)))
+                self.emit(indent, 'if v != %d:' % a)
+                self.goto(indent + 1, pc + 2)
+            elif opcode == TEST:
+                self.emit(indent, 'v = S[B+%d]' % a)
+                self.emit(indent, 'if not (v != None and v != False) == %s:'
+                          % bool(c))
+                self.goto(indent + 1, pc + 2)
+            elif opcode == TESTSET:
+                self.emit(indent, 'v = S[B+%d]' % b)
+                self.emit(indent, 'if (v != None and v != False) == %s:'
+                          % bool(c))
+                self.goto(indent + 1, pc + 2)
+                self.emit(indent, 'S[B+%d] = S[B+%d]' % (a, b))
+            elif opcode == FORLOOP:
+                a, sbx = self.decoder.getasbx(inst)
+                self.emit(indent, 'S[B+%d] += S[B+%d]' % (a, a+2))
+                self.emit(indent, 'v = S[B+%d]' % a)
+                self.emit(indent, 'limit = S[B+%d]' % (a+1))
+                self.emit(indent, 'step = S[B+%d]' % (a+2))
+                self.emit(indent, 'if (step > 0 and v <= limit) or '
+                          '(step < 0 and v >= limit):')
+                self.emit(indent + 1, 'S[B+%d] = v' % (a+3))
+                self.goto(indent + 1, pc + 1 + sbx)
+            elif opcode == FORPREP:
+                a, sbx = self.decoder.getasbx(inst)
+                self.emit(indent, 'S[B+%d] -= S[B+%d]' % (a, a+2))
+                self.goto(indent, pc + 1 + sbx)
+                return False
+            elif opcode == CLOSURE or opcode == SETLIST:
+                # both look at pc to find the words that follow them
+                self.emit_handler(indent, pc, inst)
+            elif opcode == SELF:
+                # its caches are by pc
+                self.emit_handler(indent, pc, inst)
+            elif opcode == TFORLOOP:
+                # skips the JMP back into the loop when it is done
+                self.emit_handler(indent, pc, inst)
+                self.emit(indent, 'if self.pc != %d:' % pc)
+                self.goto(indent + 1, pc + 2)
+            elif opcode in HANDLED:
+                self.emit(indent, 'OPS[%d](%d)' % (opcode, inst))
+            elif opcode in FRAME_CHANGING:
+                self.emit_handler(indent, pc, inst)
+                self.emit(indent, 'if self.depth != D or self.done:')
+                self.emit(indent + 1, 'return')
+                self.goto(indent, 'self.pc + 1')
+                return False
+            elif opcode in FRAME_LEAVING:
+                self.emit_handler(indent, pc, inst)
+                self.emit(indent, 'return')
+                return False
+            else:
+                raise AssertionError('unknown opcode %d' % opcode)
+            pc = next_pc
+        return True
+
+    def emit_dispatch(self, indent, leaders, ends):
+        """ Emits a binary search on pc over leaders, with each block's
+        code at the leaves.
+        """
+        if len(leaders) == 1:
+            start = leaders[0]
+            self.emit(indent, 'if pc == %d:' % start)
+            if self.emit_block(indent + 1, start, ends[start]):
+                self.goto(indent + 1, ends[start])
+            return
+        middle = len(leaders) / 2
+        self.emit(indent, 'if pc < %d:' % leaders[middle])
+        self.emit_dispatch(indent + 1, leaders[:middle], ends)
+        self.emit(indent, 'else:')
+        self.emit_dispatch(indent + 1, leaders[middle:], ends)
+
+    def generate(self):
+        """ Returns the source of a function named make_run, which takes
+        the LuaFunction, its instructions, the list of its constant values,
+        its global cache lists and its table field cache lists, and returns the function that runs it,
+        taking the interpreter.
+        """
+        leaders = self.find_leaders()
+        ends = {}
+        for i in xrange(len(leaders)):
+            if i + 1 < len(leaders):
+                ends[leaders[i]] = leaders[i+1]
+            else:
+                ends[leaders[i]] = len(self.instructions)
+        self.emit(2, 'while True:')
+        self.emit_dispatch(3, leaders, ends)
+        # pc is not the start of a block, so run the instruction there
+        # with its handler
+        self.emit(3, 'self.pc = pc')
+        self.emit(3, 'inst = I[pc]')
+        self.emit(3, 'OPS[inst & 0x0000003f](inst)')
+        self.emit(3, 'if self.depth != D or self.done:')
+        self.emit(4, 'return')
+        self.emit(3, 'pc = self.pc + 1')
+        body = self.lines
+        self.lines = []
+        self.emit(0, 'def make_run(F, I, K, GV, GS, TS, TL, TN):')
+        self.emit(1, 'def run(self):')
+        self.emit(2, 'S = self.stack')
+        self.emit(2, 'B = self.base')
+        self.emit(2, 'D = self.depth')
+        self.emit(2, 'U = self.upvalues')
+        self.emit(2, 'G = self.globals')
+        self.emit(2, 'V = G.values')
+        self.emit(2, 'OPS = self.op_functions')
+        for index in sorted(self.constants_used):
+            self.emit(2, 'k%d = K[%d]' % (index, index))
+        self.emit(2, 'pc = self.pc')
+        self.lines.extend(body)
+        self.emit(1, 'return run')
+        return '\n'.join(self.lines) + '\n'
+
+def compile_function(function, decoder):
+    """ Returns the compiled Python function for a LuaFunction, which
+    takes the interpreter running it.
+    """
+    source = FunctionCompiler(function, decoder).generate()
+    namespace = {'LuaTable': LuaTable}
+    code = compile(source, '<compiled %s>' % function.as_str(), 'exec')
+    exec code in namespace
+    versions, slots = decoder.global_cache(function)
+    shapes, field_slots, next_shapes = decoder.table_cache(function)
+    return namespace['make_run'](function, function.instructions,
+                                 [k.value for k in function.constants],
+                                 versions, slots,
+                                 shapes, field_slots, next_shapes)
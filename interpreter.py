@@ -1,10 +1,25 @@
 #!/usr/bin/env python
 
-import struct
 import library
+import codegen
+import superinst
+import quicken
 from luatypes import *
+from opcodes import *
 
 FIELDS_PER_FLUSH = 50 # for use by setlist
+STACK_SIZE = 256 # value stack slots to start with
+FRAME_POOL_SIZE = 64 # call frames to start with
+META_LOOP = 100 # most __index or __newindex tables followed in a lookup
+
+def fb2int(x):
+    """ Decodes the "floating point byte" NEWTABLE gives its size hints
+    in: eeeeexxx is x if eeeee is 0, and (1xxx) * 2**(eeeee-1) if not.
+    """
+    e = (x >> 3) & 0x1f
+    if e == 0:
+        return x
+    return ((x & 0x07) + 8) << (e - 1)
 
 lua_globals = {
     'assert': library.lua_assert,
@@ -45,21 +60,49 @@ lua_globals = {
     }
 
 class Frame:
-    def __init__(self, function, registers, tos, upvalues, pc):
-        self.function = function
-        self.registers = registers
-        self.tos = tos
-        self.upvalues = upvalues
-        self.pc = pc
+    """ The state of a function while a lua function it called runs, and
+    where that function's results go.  Frames are kept in a pool and
+    reused, so calls allocate nothing.
+    """
+    def __init__(self):
+        self.function = None
+        self.base = 0
+        self.start = 0
+        self.num_varargs = 0
+        self.tos = 0
+        self.upvalues = None
+        self.pc = 0
+        self.call_a = 0
+        self.call_c = 1
 
 class Interpreter:
-    def __init__(self, lua_object, arg, print_trace=False):
-        self.globals = LuaTable(hash=lua_globals)
+    def __init__(self, lua_object, arg, print_trace=False, checked=False,
+                 compile=False, fuse=None, adaptive=True):
+        self.globals = GlobalTable(hash=lua_globals)
+        self.globals.set('_G', self.globals)
         self.globals.set('arg', LuaTable(array=arg[1:], hash={0: arg[0]}))
         self.top_level_func = lua_object.top_level_func
-        self.stack = [] # call stack
+        # the value stack, shared by all frames.  The registers of the
+        # current function start at base, and its varargs are just below.
+        # Its frame, where its arguments were passed, starts at start.
+        self.stack = []
+        self.base = 0
+        self.start = 0
+        self.num_varargs = 0
+        # the upvalues of registers still on the stack, sorted by index
+        self.open_upvalues = []
+        # call stack, frames[:depth] are in use
+        self.frames = [Frame() for _ in xrange(FRAME_POOL_SIZE)]
+        self.depth = 0
         self.done = False
         self.print_trace = print_trace
+        self.checked = checked
+        self.compile = compile
+        # pairs of opcodes to fuse into superinstructions, if any
+        self.fuse = fuse
+        # whether to quicken arithmetic and compares, see quicken.py.  The
+        # compiled tier specializes them its own way.
+        self.adaptive = adaptive and not compile and not print_trace
         self.op_functions = \
             [self.move, self.loadk, self.loadbool, self.loadnil,
              self.getupval, self.getglobal, self.gettable,
@@ -70,32 +113,95 @@ class Interpreter:
              self.test, self.testset, self.call, self.tailcall,
              self.return_, self.forloop, self.forprep, self.tforloop,
              self.setlist, self.close, self.closure, self.vararg]
+        if print_trace:
+            # only wrap the handlers when tracing, so that running
+            # without --trace does no work at all for it
+            self.op_functions = [self.traced(opcode) for opcode
+                                 in xrange(len(self.op_functions))]
+            # and trace superinstructions as the instructions they stand
+            # for, one at a time
+            self.op_functions.extend([self.op_functions[opcode] for opcode
+                                      in superinst.UNFUSED])
+        else:
+            fused = [self.fused_straight(self.op_functions[opcode])
+                     for opcode in superinst.STRAIGHT]
+            if self.adaptive:
+                for opcode in quicken.QUICKENED:
+                    self.op_functions[opcode] = self.quickening(opcode)
+            self.op_functions.extend(fused)
+            self.op_functions.extend([self.eq_jmp, self.lt_jmp, self.le_jmp,
+                                      self.test_jmp, self.forloop_body])
+        self.op_functions.append(self.quick)
 
     # runs the top level function
     def run(self):
         # initialize data for current function
         self.function = self.top_level_func
-        self.registers = [LuaValue(None) for _ in xrange(self.function.max_stack_size)]
-        self.tos = len(self.registers)
-        self.upvalues = self.function.upv if hasattr(self.function, 'upv') else []
+        self.stack = [None] * max(STACK_SIZE, self.function.max_stack_size)
+        self.base = 0
+        self.start = 0
+        self.num_varargs = 0
+        self.tos = self.function.max_stack_size
+        self.upvalues = []
         self.pc = 0 # program counter
+        if self.fuse is not None:
+            superinst.fuse_function(self.function, self.fuse)
+        if self.checked:
+            self.run_checked()
+            return
+        if self.compile and not self.print_trace:
+            self.run_compiled()
+            return
         # main loop
         while not self.done and self.pc < len(self.function.instructions):
-            inst_bytestring = self.function.instructions[self.pc]
-            inst = struct.unpack('I', inst_bytestring)[0]
+            inst = self.function.instructions[self.pc]
             opcode = inst & 0x0000003f
             self.op_functions[opcode](inst)
             self.pc += 1
-            # LuaValue instances must only exist in the registers and
-            # upvalues lists, and nowhere else.
-            for reg in self.registers:
-                assert isinstance(reg, LuaValue)
-            for upv in self.upvalues:
-                assert isinstance(upv, LuaValue)
-            for g in self.globals.array:
-                assert not isinstance(g, LuaValue)
-            for g in self.globals.hash:
-                assert not isinstance(g, LuaValue)
+
+    def run_checked(self):
+        """ Same as the main loop of run, but checks the interpreter's
+        state with check_state after every instruction.  This makes each
+        instruction cost as much as the number of registers and globals,
+        so it is only done when debugging the interpreter (--checked).
+        """
+        while not self.done and self.pc < len(self.function.instructions):
+            inst = self.function.instructions[self.pc]
+            opcode = inst & 0x0000003f
+            self.op_functions[opcode](inst)
+            self.pc += 1
+            self.check_state()
+
+    def run_compiled(self):
+        """ Same as the main loop of run, but runs each lua function with
+        the Python code codegen generates for it, which is compiled the
+        first time the function runs and kept on it.  The compiled code
+        returns each time the current frame changes.
+        """
+        while not self.done and self.pc < len(self.function.instructions):
+            function = self.function
+            if function.compiled is None:
+                function.compiled = codegen.compile_function(function, self)
+            function.compiled(self)
+            self.pc += 1
+
+    def check_state(self):
+        # LuaValue instances must only exist in the upvalues lists, and
+        # nowhere else.
+        for reg in self.stack:
+            assert not isinstance(reg, LuaValue)
+        for upv in self.upvalues:
+            assert isinstance(upv, LuaValue)
+        last = -1
+        for upv in self.open_upvalues:
+            assert upv.index > last
+            last = upv.index
+        for g in self.globals.array:
+            assert not isinstance(g, LuaValue)
+        for g in self.globals.hash_values:
+            assert not isinstance(g, LuaValue)
+        for g in self.globals.values:
+            assert not isinstance(g, LuaValue)
 
     @staticmethod
     def getabc(inst):
@@ -118,404 +224,1036 @@ class Interpreter:
 
     def move(self, inst):
         a, b, _ = self.getabc(inst)
-        self.registers[a].value = self.registers[b].value
-        self.trace('MOVE', [a, b], [a])
+        self.stack[self.base+a] = self.stack[self.base+b]
 
     def loadk(self, inst):
         a, bx = self.getabx(inst)
-        self.registers[a].value = self.function.constants[bx].value
-        self.trace('LOADK', [a, bx], [a])
+        self.stack[self.base+a] = self.function.constants[bx].value
         
     def loadbool(self, inst):
         a, b, c = self.getabc(inst)
-        self.registers[a].value = True if b else False
+        self.stack[self.base+a] = True if b else False
         if c:
             self.pc += 1
-        self.trace('LOADBOOL', [a, b, c], [a])
 
     def loadnil(self, inst):
         a, b, _ = self.getabc(inst)
         for i in xrange(a, b+1):
-            self.registers[i].value = None
-        self.trace('LOADNIL', [a, b], range(a, b+1))
+            self.stack[self.base+i] = None
 
     def getupval(self, inst):
         a, b, _ = self.getabc(inst)
-        self.registers[a].value = self.upvalues[b].value
-        self.trace('GETUPVAL', [a, b], [a])
+        upvalue = self.upvalues[b]
+        if upvalue.index < 0:
+            self.stack[self.base+a] = upvalue.value
+        else:
+            self.stack[self.base+a] = self.stack[upvalue.index]
 
     def getglobal(self, inst):
         a, bx = self.getabx(inst)
-        global_name = self.function.constants[bx].value
-        self.registers[a].value = self.globals.get(global_name)
-        self.trace('GETGLOBAL', [a, bx], [a])
+        globals = self.globals
+        function = self.function
+        versions = function.global_versions
+        if versions is not None and versions[self.pc] == globals.version:
+            slot = function.global_slots[self.pc]
+        else:
+            slot = self.cache_global(function, self.pc, bx)
+        value = globals.values[slot]
+        if value is None and globals.metatable is not None:
+            # not a global, so up to _G's __index
+            value = self.index_constant(function, self.pc, globals,
+                                        function.constants[bx].value)
+        self.stack[self.base+a] = value
 
     def gettable(self, inst):
         a, b, c = self.getabc(inst)
-        table = self.registers[b].value
-        index = self.rk(c)
-        self.registers[a].value = table.get(index)
-        self.trace('GETTABLE', [a, b, c], [a])
+        table = self.stack[self.base+b]
+        if c & 256:
+            # a constant key, so maybe a field in the slot cached for pc
+            function = self.function
+            shapes = function.table_shapes
+            if (shapes is not None and type(table) is LuaTable and
+                table.shape is shapes[self.pc]):
+                value = table.fields[function.table_slots[self.pc]]
+                if value is not None:
+                    self.stack[self.base+a] = value
+                    return
+            self.stack[self.base+a] = self.index_constant(
+                function, self.pc, table, function.constants[c-256].value)
+        else:
+            key = self.stack[self.base+c]
+            if type(table) is LuaTable and table.metatable is None:
+                self.stack[self.base+a] = table.get(key)
+            else:
+                self.stack[self.base+a] = self.index(table, key)
 
     def setglobal(self, inst):
         a, bx = self.getabx(inst)
-        global_name = self.function.constants[bx].value
-        self.globals.set(global_name, self.registers[a].value)
-        self.trace('SETGLOBAL', [a, bx], [])
+        globals = self.globals
+        function = self.function
+        versions = function.global_versions
+        if versions is not None and versions[self.pc] == globals.version:
+            slot = function.global_slots[self.pc]
+        else:
+            slot = self.cache_global(function, self.pc, bx)
+        metatable = globals.metatable
+        if slot and (metatable is None or globals.values[slot] is not None):
+            globals.values[slot] = self.stack[self.base+a]
+        elif metatable is None:
+            # a new global, which gets a slot
+            globals.set(function.constants[bx].value, self.stack[self.base+a])
+        else:
+            # a new or nil global, so up to _G's __newindex
+            self.newindex_constant(function, self.pc, globals,
+                                   function.constants[bx].value,
+                                   self.stack[self.base+a])
+
+    def global_cache(self, function):
+        """ Returns the lists of the version of the globals table and the
+        slot in it that GETGLOBAL and SETGLOBAL instructions in function
+        last looked up, by pc.
+        """
+        if function.global_versions is None:
+            function.global_versions = [0] * len(function.instructions)
+            function.global_slots = [0] * len(function.instructions)
+        return function.global_versions, function.global_slots
+
+    def index_cache(self, function):
+        """ Returns the list of what GETTABLE and SELF instructions with a
+        constant key in function last found through the __index chain of
+        a table, by pc, as tuples of the table's shape and metatable,
+        LuaTable.watched_version then and the value found.
+        """
+        if function.index_cache is None:
+            function.index_cache = [None] * len(function.instructions)
+        return function.index_cache
+
+    def table_cache(self, function):
+        """ Returns the lists of the shape of the table that GETTABLE,
+        SETTABLE and SELF instructions with a constant key in function
+        last found the key in, the key's slot in it and, for a SETTABLE
+        that added the key, the shape the table moved on to, by pc.
+        """
+        if function.table_shapes is None:
+            function.table_shapes = [None] * len(function.instructions)
+            function.table_slots = [0] * len(function.instructions)
+            function.table_next_shapes = [None] * len(function.instructions)
+        return (function.table_shapes, function.table_slots,
+                function.table_next_shapes)
+
+    def cache_field(self, function, pc, table, key, old_shape=None):
+        # caches the slot of key in table for the instruction at pc, if it
+        # is one of its fields.  old_shape is the shape table had before
+        # a SETTABLE set key.
+        if type(table) is not LuaTable:
+            return
+        slot = table.shape.slots.get(key, -1)
+        if slot < 0 or (old_shape is not None and table.shape.watched):
+            return
+        shapes, slots, next_shapes = self.table_cache(function)
+        if old_shape is None or old_shape is table.shape:
+            shapes[pc] = table.shape
+            next_shapes[pc] = None
+        elif slot == len(old_shape.keys):
+            # key was added
+            shapes[pc] = old_shape
+            next_shapes[pc] = table.shape
+        else:
+            return
+        slots[pc] = slot
+
+    def cache_global(self, function, pc, bx):
+        # looks up the slot of the global named by constant bx for the
+        # instruction at pc, and caches it
+        versions, slots = self.global_cache(function)
+        slot = self.globals.slot(function.constants[bx].value)
+        versions[pc] = self.globals.version
+        slots[pc] = slot
+        return slot
 
     def setupval(self, inst):
         a, b, _ = self.getabc(inst)
-        self.upvalues[b] = self.registers[a]
-        self.trace('SETUPVAL', [a, b], [])
+        upvalue = self.upvalues[b]
+        if upvalue.index < 0:
+            upvalue.value = self.stack[self.base+a]
+        else:
+            self.stack[upvalue.index] = self.stack[self.base+a]
 
     def settable(self, inst):
         a, b, c = self.getabc(inst)
-        table = self.registers[a].value
-        index = self.rk(b)
-        table.set(index, self.rk(c))
-        self.trace('SETTABLE', [a, b, c], [])
+        table = self.stack[self.base+a]
+        if b & 256:
+            # a constant key, so maybe a field in the slot cached for pc,
+            # or a new one that moves table on to the shape cached for pc,
+            # unless table has a metatable and the field is nil or new
+            function = self.function
+            shapes = function.table_shapes
+            if (shapes is not None and type(table) is LuaTable and
+                table.shape is shapes[self.pc]):
+                next_shape = function.table_next_shapes[self.pc]
+                if next_shape is None:
+                    fields = table.fields
+                    slot = function.table_slots[self.pc]
+                    if table.metatable is None or fields[slot] is not None:
+                        fields[slot] = self.rk(c)
+                        return
+                elif table.metatable is None:
+                    table.shape = next_shape
+                    table.add_field(self.rk(c))
+                    return
+            self.newindex_constant(function, self.pc, table,
+                                   function.constants[b-256].value,
+                                   self.rk(c))
+        else:
+            key = self.stack[self.base+b]
+            if type(table) is LuaTable and table.metatable is None:
+                table.set(key, self.rk(c))
+            else:
+                self.newindex(table, key, self.rk(c))
 
     def newtable(self, inst):
         a, b, c = self.getabc(inst)
-        if b or c:
-            b_x =  b & 0x07       # right 3 bits
-            b_e = (b & 0xf8) >> 3 # left 5 bits
-            c_x =  c * 0x07
-            c_e = (c & 0x1f) >> 3
-            array_size = b_x if b_e == 0 else (10 + b_x) * (2 ** (b_e - 1))
-            hash_size  = c_x if c_e == 0 else (10 + c_x) * (2 ** (c_e - 1))
-            array = [None for _ in xrange(array_size)]
-            self.registers[a].value = LuaTable(array=array, hash={})
-        else:
-            self.registers[a].value = LuaTable(array=[], hash={})
-        self.trace('NEWTABLE', [a, b, c], [a])
+        # the sizes the constructor's array and hash parts will need
+        self.stack[self.base+a] = LuaTable(array=[None] * fb2int(b),
+                                           hash_size=fb2int(c))
 
     def self_(self, inst):
         a, b, c = self.getabc(inst)
-        table = self.registers[b].value
-        self.registers[a+1].value = b
-        self.registers[a].value = table.get(self.rk(c))
-        self.trace('SELF', [a, b, c], [a+1, a])
+        stack = self.stack
+        base = self.base
+        obj = stack[base+b]
+        stack[base+a+1] = obj
+        if c & 256:
+            # a method inherited through __index, as cached for pc, or one
+            # in a field of obj itself
+            function = self.function
+            pc = self.pc
+            cache = function.index_cache
+            if cache is not None:
+                entry = cache[pc]
+                if entry is not None and entry[2] == LuaTable.watched_version:
+                    if type(obj) is LuaTable:
+                        if (obj.shape is entry[0] and
+                            obj.metatable is entry[1]):
+                            stack[base+a] = entry[3]
+                            return
+                    elif type(obj) is str and entry[0] is str:
+                        stack[base+a] = entry[3]
+                        return
+            shapes = function.table_shapes
+            if (shapes is not None and type(obj) is LuaTable and
+                obj.shape is shapes[pc]):
+                value = obj.fields[function.table_slots[pc]]
+                if value is not None:
+                    stack[base+a] = value
+                    return
+            stack[base+a] = self.index_constant(
+                function, pc, obj, function.constants[c-256].value)
+        else:
+            stack[base+a] = self.index(obj, stack[base+c])
         
     def add(self, inst):
         a, b, c = self.getabc(inst)
-        self.registers[a].value = self.rk(b) + self.rk(c)
-        self.trace('ADD', [a, b, c], [a])
+        x = self.rk(b)
+        y = self.rk(c)
+        try:
+            self.stack[self.base+a] = x + y
+        except TypeError:
+            self.stack[self.base+a] = self.arith('__add', x, y)
 
     def sub(self, inst):
         a, b, c = self.getabc(inst)
-        self.registers[a].value = self.rk(b) - self.rk(c)
-        self.trace('SUB', [a, b, c], [a])
+        x = self.rk(b)
+        y = self.rk(c)
+        try:
+            self.stack[self.base+a] = x - y
+        except TypeError:
+            self.stack[self.base+a] = self.arith('__sub', x, y)
 
     def mul(self, inst):
         a, b, c = self.getabc(inst)
-        self.registers[a].value = self.rk(b) * self.rk(c)
-        self.trace('MUL', [a, b, c], [a])
+        x = self.rk(b)
+        y = self.rk(c)
+        try:
+            self.stack[self.base+a] = x * y
+        except TypeError:
+            self.stack[self.base+a] = self.arith('__mul', x, y)
 
     def div(self, inst):
         a, b, c, = self.getabc(inst)
-        self.registers[a].value = self.rk(b) / self.rk(c)
-        self.trace('DIV', [a, b, c], [a])
+        x = self.rk(b)
+        y = self.rk(c)
+        try:
+            self.stack[self.base+a] = x / y
+        except TypeError:
+            self.stack[self.base+a] = self.arith('__div', x, y)
 
     def mod(self, inst):
         a, b, c = self.getabc(inst)
-        self.registers[a].value = self.rk(b) % self.rk(c)
-        self.trace('MOD', [a, b, c], [a])
+        x = self.rk(b)
+        y = self.rk(c)
+        try:
+            self.stack[self.base+a] = x % y
+        except TypeError:
+            self.stack[self.base+a] = self.arith('__mod', x, y)
 
     def pow(self, inst):
         a, b, c = self.getabc(inst)
-        self.registers[a].value = self.rk(b) ** self.rk(c)
-        self.trace('POW', [a, b, c], [a])
+        x = self.rk(b)
+        y = self.rk(c)
+        try:
+            self.stack[self.base+a] = x ** y
+        except TypeError:
+            self.stack[self.base+a] = self.arith('__pow', x, y)
 
     def unm(self, inst):
         a, b, _ = self.getabc(inst)
-        self.registers[a].value = -self.registers[b].value
-        self.trace('UNM', [a, b], [a])
+        x = self.stack[self.base+b]
+        try:
+            self.stack[self.base+a] = -x
+        except TypeError:
+            self.stack[self.base+a] = self.arith('__unm', x, x)
 
     def not_(self, inst):
         a, b, _ = self.getabc(inst)
-        self.registers[a].value = not self.registers[b].value
-        self.trace('NOT', [a, b], [a])
+        self.stack[self.base+a] = not self.stack[self.base+b]
 
     def len(self, inst):
         a, b, _ = self.getabc(inst)
-        self.registers[a].value = len(self.registers[b].value)
-        self.trace('LEN', [a, b], [a])
+        value = self.stack[self.base+b]
+        if type(value) is LuaTable:
+            self.stack[self.base+a] = value.length()
+        else:
+            self.stack[self.base+a] = len(value)
 
     def concat(self, inst):
         a, b, c = self.getabc(inst)
-        self.registers[a].value = ''.join([self.registers[i].value for i in xrange(b, c+1)])
-        self.trace('CONCAT', [a, b, c], [a])
+        self.stack[self.base+a] = ''.join([self.stack[self.base+i] for i in xrange(b, c+1)])
 
     def jmp(self, inst):
         _, sbx = self.getasbx(inst)
         self.pc += sbx
-        self.trace('JMP', [sbx], [])
 
     def eq(self, inst):
         a, b, c = self.getabc(inst)
-        rkb = self.rk(b)
-        rkc = self.rk(c)
-        if (rkb == rkc) != a:
+        if self.equal(self.rk(b), self.rk(c)) != a:
             self.pc += 1
-        self.trace('EQ', [a, b, c], [])
 
     def lt(self, inst):
         a, b, c = self.getabc(inst)
-        rkb = self.rk(b)
-        rkc = self.rk(c)
-        if (rkb < rkc) != a:
+        if self.less_than(self.rk(b), self.rk(c)) != a:
             self.pc += 1
-        self.trace('LT', [a, b, c], [])
 
     def le(self, inst):
         a, b, c = self.getabc(inst)
-        rkb = self.rk(b)
-        rkc = self.rk(c)
-        if (rkb <= rkc) != a:
+        if self.less_equal(self.rk(b), self.rk(c)) != a:
             self.pc += 1
-        self.trace('LE', [a, b, c], [])
 
     def test(self, inst):
         a, _, c = self.getabc(inst)
-        ra = self.registers[a].value
+        ra = self.stack[self.base+a]
         if not (ra != None and ra != False) == bool(c):
             self.pc += 1
-        self.trace('TEST', [a, c], [])
 
     def testset(self, inst):
         a, b, c = self.getabc(inst)
-        rb = self.registers[b].value
+        rb = self.stack[self.base+b]
         if (rb != None and rb != False) == bool(c):
             self.pc += 1
         else:
-            self.registers[a].value = self.registers[b].value
-        self.trace('TESTSET', [a, b, c], [a] if rb == c else [])
+            self.stack[self.base+a] = self.stack[self.base+b]
 
     def call(self, inst):
         a, b, c = self.getabc(inst)
-        function = self.registers[a].value
-        args = []
+        stack = self.stack
+        base = self.base
+        function = stack[base+a]
         if b == 0:
-            # parameters are self.registers[a+1] to top of stack
-            args.extend([r.value for r in self.registers[a+1:self.tos]])
-        elif b >= 2:
-            # there are b-1 parameters
-            # so add b-1 parameters from registers to the args list
-            args.extend([r.value for r in self.registers[a+1:a+b]])
-        # call function
-        results = self.fcall(function, args)
-        # save results here if it was a library function
-        modified_regs = []
-        is_lua_function = not hasattr(function, '__call__')
-        if is_lua_function:
-            # store current a and c operand values into this frame,
-            # the return instruction will use it
-            self.stack[len(self.stack)-1].call_a = a
-            self.stack[len(self.stack)-1].call_c = c
+            # parameters are r[a+1] to top of stack
+            nargs = self.tos - a - 1
         else:
-            if c == 0:
-                # save return results into registers staring from r[a]
-                l = len(results)
-                modified_regs = range(a, l)
-                for i in xrange(l):
-                    self.registers[a+i].value = results[i]
-                # set top of stack to last register assigned
-                self.tos = a + l
-                    
-            elif c >= 2:
-                # save c-1 return results starting from r[a]
-                modified_regs = range(a, c-1)
-                for i in xrange(c-1):
-                    self.registers[a+i].value = results[i]
-        self.trace('CALL', [a, b, c], modified_regs, is_lua_function)
+            # there are b-1 parameters
+            nargs = b - 1
+        if type(function) is LuaClosure:
+            # a lua function, whose registers start at its first argument.
+            # The return instruction saves its results using a and c.
+            self.enter(function, base+a+1, nargs, a, c)
+            return
+        if isinstance(function, LuaTable):
+            function = self.call_handler(a, nargs)
+            nargs += 1
+            if type(function) is LuaClosure:
+                self.enter(function, base+a+1, nargs, a, c)
+                return
+        # otherwise function is a python function i.e. a native library
+        # function
+        results = function(stack[base+a+1:base+a+1+nargs]) or []
+        if c == 0:
+            # save return results into registers staring from r[a]
+            l = len(results)
+            self.ensure_stack(base + a + l)
+            stack[base+a:base+a+l] = results
+            # set top of stack to last register assigned
+            self.tos = a + l
+        elif c >= 2:
+            # save c-1 return results starting from r[a], padded with nil
+            l = len(results)
+            for i in xrange(c-1):
+                stack[base+a+i] = results[i] if i < l else None
 
     def tailcall(self, inst):
         a, b, _ = self.getabc(inst)
-        function = self.registers[a].value
-        args = [r.value for r in self.registers[a+1:a+b]]
-        self.function = function
-        self.registers = [LuaValue(arg) for arg in args]
-        while len(self.registers) < function.max_stack_size:
-            self.registers.append(LuaValue(None))
-        self.upvalues = function.upv
-        self.pc = -1
-        self.trace('TAILCALL', [a, b], [])
+        stack = self.stack
+        base = self.base
+        function = stack[base+a]
+        nargs = b - 1 if b else self.tos - a - 1
+        if isinstance(function, LuaTable):
+            function = self.call_handler(a, nargs)
+            nargs += 1
+        if type(function) is not LuaClosure:
+            # a library function, so return whatever it returns
+            results = function(stack[base+a+1:base+a+1+nargs]) or []
+            l = len(results)
+            self.ensure_stack(base + a + l)
+            stack[base+a:base+a+l] = results
+            self.leave(a, l)
+            return
+        # reuse this frame: move the arguments down to where it starts,
+        # below any varargs and the parameters setup moved above them
+        if self.open_upvalues:
+            self.close_upvalues(self.start)
+        start = self.start
+        stack[start:start+nargs] = stack[base+a+1:base+a+1+nargs]
+        self.setup(function, start, nargs)
 
     def return_(self, inst):
         a, b, _ = self.getabc(inst)
-        results = []
         if b == 0:
-            # results are in registers r[a] onwards
-            results.extend([r.value for r in self.registers[a:]])
-        elif b >= 2:
+            # results are in registers r[a] to top of stack
+            self.leave(a, self.tos - a)
+        else:
             # there are b - 1 results starting from r[a]
-            results.extend([r.value for r in self.registers[a:a+b-1]])
-        # close all open variables
-        for reg in self.registers[a:]:
-            for (cl, i) in reg.referencing_closures:
-                cl.upv[i] = LuaValue(reg.value)
+            self.leave(a, b - 1)
+
+    def leave(self, a, n):
+        # returns from the current function with the n results in
+        # registers r[a] onwards
+        if self.open_upvalues:
+            self.close_upvalues(self.base)
         # done if the call stack is empty
-        if len(self.stack) == 0:
+        if self.depth == 0:
             self.done = True
             return
+        stack = self.stack
+        src = self.base + a
         # pop last frame
-        last_frame = self.stack.pop()
-        self.function = last_frame.function
-        self.registers = last_frame.registers
-        self.tos = last_frame.tos
-        self.upvalues = last_frame.upvalues
-        self.pc = last_frame.pc
-        call_a = last_frame.call_a
-        call_c = last_frame.call_c
+        self.depth -= 1
+        frame = self.frames[self.depth]
+        self.function = frame.function
+        self.base = frame.base
+        self.start = frame.start
+        self.num_varargs = frame.num_varargs
+        self.tos = frame.tos
+        self.upvalues = frame.upvalues
+        self.pc = frame.pc
+        call_a = frame.call_a
+        call_c = frame.call_c
+        dst = self.base + call_a
         if call_c == 0:
             # save return results into registers staring from r[a]
-            l = len(results)
-            for i in xrange(l):
-                self.registers[call_a+i].value = results[i]
-            self.tos = call_a + l
+            stack[dst:dst+n] = stack[src:src+n]
+            self.tos = call_a + n
         elif call_c >= 2:
-            # save c-1 return results starting from r[a]
-            for i in xrange(call_c-1):
-                self.registers[call_a+i].value = results[i]
-        self.trace('RETURN', [a, b], [], True)
-        
+            # save c-1 return results starting from r[a], with nil for
+            # any missing ones
+            wanted = call_c - 1
+            if n >= wanted:
+                stack[dst:dst+wanted] = stack[src:src+wanted]
+            else:
+                stack[dst:dst+wanted] = stack[src:src+n] + [None] * (wanted - n)
+
     def forloop(self, inst):
         a, sbx = self.getasbx(inst)
-        self.registers[a].value += self.registers[a+2].value
-        ra = self.registers[a].value
-        ra1 = self.registers[a+1].value
-        ra2 = self.registers[a+2].value
-        do_loop = False
+        self.stack[self.base+a] += self.stack[self.base+a+2]
+        ra = self.stack[self.base+a]
+        ra1 = self.stack[self.base+a+1]
+        ra2 = self.stack[self.base+a+2]
         if (ra2 > 0 and ra <= ra1) or (ra2 < 0 and ra >= ra1):
-            do_loop = True
             self.pc += sbx
-            self.registers[a+3].value = ra
-        self.trace('FORLOOP', [a, sbx], [a+3] if do_loop else [])
+            self.stack[self.base+a+3] = ra
 
     def forprep(self, inst):
         a, sbx = self.getasbx(inst)
-        self.registers[a].value -= self.registers[a+2].value
+        self.stack[self.base+a] -= self.stack[self.base+a+2]
         self.pc += sbx
-        self.trace('FORPREP', [a, sbx], [a])
 
     def tforloop(self, inst):
         a, _, c = self.getabc(inst)
-        iter_func = self.registers[a].value
-        state = self.registers[a+1].value
-        index = self.registers[a+2].value
-        modified_regs = []
-        results = self.fcall(iter_func, [state, index])
-        if results == None:
-            results = [None for _ in xrange(c)]
-        for i in xrange(c):
-            self.registers[a+3+i].value = results[i]
-            modified_regs.append(a+3+i)
-        if self.registers[a+3].value is not None:
-            self.registers[a+2].value = self.registers[a+3].value
-            modified_regs.append(a+2)
+        stack = self.stack
+        ra = self.base + a
+        iter_func = stack[ra]
+        state = stack[ra+1]
+        if iter_func is library.lua_next and isinstance(state, LuaTable):
+            # pairs: step the table straight into the loop variables
+            key, value = state.next(stack[ra+2])
+        elif iter_func is library.ipairs_next and isinstance(state, LuaTable):
+            key = int(stack[ra+2]) + 1
+            value = state.get(key)
+            if value is None:
+                key = None
         else:
+            results = self.call_function(iter_func, [state, stack[ra+2]])
+            for i in xrange(c):
+                stack[ra+3+i] = results[i] if i < len(results) else None
+            if stack[ra+3] is not None:
+                stack[ra+2] = stack[ra+3]
+            else:
+                self.pc += 1
+            return
+        if key is None:
             self.pc += 1
-        self.trace('TFORLOOP', [a, c], modified_regs)
+            return
+        stack[ra+2] = key
+        stack[ra+3] = key
+        if c > 1:
+            stack[ra+4] = value
+            for i in xrange(2, c):
+                stack[ra+3+i] = None
 
     def setlist(self, inst):
         a, b, c = self.getabc(inst)
-        table = self.registers[a].value
+        table = self.stack[self.base+a]
         if b == 0:
             # set table from elements from r[a+1] to top of stack
-            for i in xrange(1, len(self.registers[(a+1):])):
-                table.set((c-1)*FIELDS_PER_FLUSH+i,
-                          self.registers[a+i].value)
-        else:
-            if c == 0:
-                # cast next instruction as int and let that be c
-                c = self.function.instructions[self.pc+1]
-                self.pc += 1 # and skip next instruction as its not an instruction
-            for i in xrange(1, b+1):
-                table.set((c-1)*FIELDS_PER_FLUSH+i,
-                          self.registers[a+i].value)
-        self.trace('SETLIST', [a, b, c], [])
+            b = self.tos - a - 1
+        if c == 0:
+            # next instruction is the raw value of c
+            c = self.function.instructions[self.pc+1]
+            self.pc += 1 # and skip next instruction as its not an instruction
+        start = self.base + a + 1
+        table.set_list((c-1)*FIELDS_PER_FLUSH, self.stack[start:start+b])
 
     def close(self, inst):
         a, _, _ = self.getabc(inst)
-        for reg in self.registers[a:]:
-            for (cl, i) in reg.referencing_closures:
-                cl.upv[i] = LuaValue(reg.value)
-        self.trace('CLOSE', [a], [])
+        self.close_upvalues(self.base + a)
 
     def closure(self, inst):
         a, bx = self.getabx(inst)
-        closure_func = self.function.prototypes[bx]
-        self.registers[a].value = closure_func
-        self.function.prototypes[bx].upv = [None] * closure_func.num_upvalues
+        closure_func = self.function.get_prototype(bx)
+        if self.fuse is not None and not closure_func.fused:
+            superinst.fuse_function(closure_func, self.fuse)
+        upvalues = [None] * closure_func.num_upvalues
+        self.stack[self.base+a] = LuaClosure(closure_func, upvalues)
         for i in xrange(0, closure_func.num_upvalues):
-            inst_bytestring = self.function.instructions[self.pc + i + 1]
-            inst = struct.unpack('I', inst_bytestring)[0]
+            inst = self.function.instructions[self.pc + i + 1]
             opcode = inst & 0x0000003f
             if opcode == 0: # MOVE
                 _, b, _ = self.getabc(inst)
-                # alias this function's upv[i] to registers[b]
-                closure_func.upv[i] = self.registers[b]
-                self.registers[b].referencing_closures.append((closure_func, i))
+                # alias this closure's upvalues[i] to registers[b]
+                upvalues[i] = self.find_upvalue(self.base + b)
             else:
                 assert opcode == 4 # GETUPVAL
                 _, b, _ = self.getabc(inst)
-                # alias this function's upv[i] to upvalues[b]
-                closure_func.upv[i] = self.upvalues[b]
-                self.upvalues[b].referencing_closures.append((closure_func, i))
+                # alias this closure's upvalues[i] to upvalues[b]
+                upvalues[i] = self.upvalues[b]
         self.pc += closure_func.num_upvalues
-        self.trace('CLOSURE', [a, bx], [a])
 
     def vararg(self, inst):
         a, b, _ = self.getabc(inst)
-        argtable = self.registers[self.function.num_parameters].value \
-            if self.function.is_vararg_flag & 0x2 \
-            else None
-        self.registers.extend([LuaValue(None) for _ in
-                               xrange(len(argtable) - len(self.registers) + a)])
-        self.tos = len(self.registers)
-        modified_regs = []
-        for i in xrange(a, len(self.registers) if b == 0 else a+b-1):
-            modified_regs.append(i)
-            self.registers[i].value = argtable.get(i-a+1) if argtable else None
-        self.trace('VARARG', [a, b], modified_regs)
-
-    def fcall(self, function, args):
-        if hasattr(function, '__call__'):
-            # function is a python function i.e. a native library function
-            # so call it like a python function
-            return function(args)
+        stack = self.stack
+        base = self.base
+        n = self.num_varargs
+        if b == 0:
+            # copy all of them, and set top of stack after them
+            count = n
+            self.ensure_stack(base + a + n)
+            self.tos = a + n
+        else:
+            count = b - 1
+        if count <= n:
+            stack[base+a:base+a+count] = stack[base-n:base-n+count]
         else:
-            # otherwise function must be a lua function
-            # truncate args list to match number of parameters
-            if len(args) > function.num_parameters:
-                new_args = args[:function.num_parameters]
-                if function.is_vararg_flag & 0x2:
-                    # put the extra args in an 'arg' table
-                    arg_array = args[function.num_parameters:]
-                    arg_hash = {'n': len(arg_array)}
-                    arg = LuaTable(array=arg_array, hash=arg_hash)
-                    # and set that as the last parameter
-                    new_args.append(arg)
-                args = new_args
-            # push current frame onto stack
-            self.stack.append(Frame(self.function, self.registers,
-                                    self.tos, self.upvalues, self.pc))
-            # initialize data for current function
-            self.function = function
-            self.registers = [LuaValue(arg) for arg in args]
-            while len(self.registers) < function.max_stack_size:
-                self.registers.append(LuaValue(None))
-            self.tos = len(self.registers)
-            self.upvalues = function.upv
-            self.pc = -1
+            stack[base+a:base+a+count] = \
+                stack[base-n:base] + [None] * (count - n)
+
+    # superinstructions, see superinst.py
+
+    def fused_straight(self, handler):
+        # returns the handler for the superinstruction made of the
+        # instruction handler runs and the one after it
+        def straight_pair(inst):
+            handler(inst)
+            self.pc += 1
+            inst = self.function.instructions[self.pc]
+            self.op_functions[inst & 0x0000003f](inst)
+        return straight_pair
+
+    def jmp_unless(self, skip):
+        # the JMP after a compare or test: moves pc onto it, and then
+        # jumps unless skip, in which case the main loop moves past it
+        self.pc += 1
+        if not skip:
+            _, sbx = self.getasbx(self.function.instructions[self.pc])
+            self.pc += sbx
+
+    def eq_jmp(self, inst):
+        a, b, c = self.getabc(inst)
+        self.jmp_unless(self.equal(self.rk(b), self.rk(c)) != a)
+
+    def lt_jmp(self, inst):
+        a, b, c = self.getabc(inst)
+        self.jmp_unless(self.less_than(self.rk(b), self.rk(c)) != a)
+
+    def le_jmp(self, inst):
+        a, b, c = self.getabc(inst)
+        self.jmp_unless(self.less_equal(self.rk(b), self.rk(c)) != a)
+
+    def test_jmp(self, inst):
+        a, _, c = self.getabc(inst)
+        ra = self.stack[self.base+a]
+        self.jmp_unless(not (ra != None and ra != False) == bool(c))
+
+    def forloop_body(self, inst):
+        pc = self.pc
+        self.forloop(inst)
+        if self.pc != pc:
+            # looped, so run the first instruction of the body right away
+            self.pc += 1
+            inst = self.function.instructions[self.pc]
+            self.op_functions[inst & 0x0000003f](inst)
+
+    # quickening, see quicken.py
+
+    def quickening(self, opcode):
+        # returns the handler for opcode, counting the runs of each
+        # instruction to quicken it once it is warm
+        handler = self.op_functions[opcode]
+        def counted(inst):
+            function = self.function
+            counts = function.quick_counts
+            if counts is None:
+                counts = [0] * len(function.instructions)
+                function.quick_counts = counts
+            pc = self.pc
+            counts[pc] += 1
+            if counts[pc] == quicken.QUICKEN_THRESHOLD:
+                quicken.quicken(self, function, pc, inst)
+            handler(inst)
+        return counted
+
+    def quick(self, inst):
+        self.function.quickened[self.pc]()
+
+    # metatables
+
+    def metamethod(self, value, event):
+        # the metamethod value has for event, or None
+        if isinstance(value, LuaTable):
+            if value.metatable is not None:
+                return value.metatable.get(event)
+        elif isinstance(value, str):
+            return library.string_metatable.get(event)
+        return None
+
+    def call_metamethod(self, handler, args):
+        # calls a metamethod, returning its first result
+        results = self.call_function(handler, args)
+        return results[0] if results else None
+
+    def index(self, table, key):
+        """ Returns table[key], following __index metamethods. """
+        for _ in xrange(META_LOOP):
+            if isinstance(table, LuaTable):
+                value = table.get(key)
+                if value is not None or table.metatable is None:
+                    return value
+                handler = table.metatable.get('__index')
+                if handler is None:
+                    return None
+            else:
+                handler = self.metamethod(table, '__index')
+                if handler is None:
+                    raise AssertionError('attempt to index a %s value' %
+                                         library.lua_type([table])[0])
+            if is_function(handler):
+                return self.call_metamethod(handler, [table, key])
+            table = handler
+        raise AssertionError('loop in gettable')
+
+    def index_constant(self, function, pc, table, key):
+        """ Returns table[key] for the GETTABLE or SELF at pc in function,
+        whose key is a constant.  A key found in the table itself has its
+        slot cached with cache_field.  A key found through the table's
+        chain of __index tables is cached in index_cache instead, for as
+        long as the table keeps its shape and metatable and no table
+        along the chain changes, as they are all watched.  Strings are
+        cached the same way, with str for their shape, as they all have
+        the string metatable.
+        """
+        if type(table) is LuaTable:
+            shape = table.shape
+            metatable = table.metatable
+        elif type(table) is str:
+            shape = str
+            metatable = library.string_metatable
+        else:
+            return self.index(table, key)
+        cache = function.index_cache
+        if cache is not None:
+            entry = cache[pc]
+            if (entry is not None and shape is entry[0] and
+                metatable is entry[1] and
+                entry[2] == LuaTable.watched_version):
+                return entry[3]
+        value = None
+        if shape is not str:
+            value = table.get(key)
+            if value is not None or metatable is None:
+                self.cache_field(function, pc, table, key)
+                return value
+            if (type(key) is not str or shape is DICT_SHAPE or
+                key in shape.slots):
+                # the shape doesn't tell that the key is not in the table
+                return self.index(table, key)
+        first = metatable
+        for _ in xrange(META_LOOP):
+            if metatable is None:
+                break
+            handler = metatable.get('__index')
+            if handler is not None and type(handler) is not LuaTable:
+                # a function, which may give something else each time
+                return self.index(table, key)
+            if type(metatable) is not LuaTable:
+                return self.index(table, key)
+            metatable.watch()
+            if handler is None:
+                break
+            handler.watch()
+            value = handler.get(key)
+            if value is not None:
+                break
+            metatable = handler.metatable
+        else:
+            raise AssertionError('loop in gettable')
+        self.index_cache(function)[pc] = \
+            (shape, first, LuaTable.watched_version, value)
+        return value
+
+    def newindex(self, table, key, value):
+        """ Sets table[key] to value, following __newindex metamethods. """
+        for _ in xrange(META_LOOP):
+            if isinstance(table, LuaTable):
+                metatable = table.metatable
+                if metatable is None or table.get(key) is not None:
+                    table.set(key, value)
+                    return
+                handler = metatable.get('__newindex')
+                if handler is None:
+                    table.set(key, value)
+                    return
+            else:
+                handler = self.metamethod(table, '__newindex')
+                if handler is None:
+                    raise AssertionError('attempt to index a %s value' %
+                                         library.lua_type([table])[0])
+            if is_function(handler):
+                self.call_function(handler, [table, key, value])
+                return
+            table = handler
+        raise AssertionError('loop in settable')
+
+    def newindex_constant(self, function, pc, table, key, value):
+        # sets table[key] to value for the SETTABLE at pc in function,
+        # whose key is a constant, caching the key's slot
+        if type(table) is LuaTable:
+            shape = table.shape
+            if table.metatable is None:
+                table.set(key, value)
+            else:
+                self.newindex(table, key, value)
+            self.cache_field(function, pc, table, key, shape)
+        else:
+            self.newindex(table, key, value)
+
+    def arith(self, event, x, y):
+        """ Returns the result of an arithmetic operation on x and y, at
+        least one of which is not a number, from the metamethod of x for
+        event, or else that of y.
+        """
+        handler = self.metamethod(x, event)
+        if handler is None:
+            handler = self.metamethod(y, event)
+        if handler is None:
+            bad = y if isinstance(x, (int, long, float)) else x
+            raise AssertionError('attempt to perform arithmetic on a %s value'
+                                 % library.lua_type([bad])[0])
+        return self.call_metamethod(handler, [x, y])
+
+    def compare_handler(self, x, y, event):
+        # the metamethod for event of the tables x and y, if they have the
+        # same one
+        handler = self.metamethod(x, event)
+        if handler is None or handler is not self.metamethod(y, event):
+            return None
+        return handler
+
+    def equal(self, x, y):
+        # x == y, with the __eq metamethod for two different tables
+        if x is y or not (isinstance(x, LuaTable) and isinstance(y, LuaTable)):
+            return x == y
+        handler = self.compare_handler(x, y, '__eq')
+        if handler is None:
+            return False
+        return is_true(self.call_metamethod(handler, [x, y]))
+
+    def less_than(self, x, y):
+        # x < y, with the __lt metamethod for tables
+        if isinstance(x, LuaTable) and isinstance(y, LuaTable):
+            handler = self.compare_handler(x, y, '__lt')
+            if handler is None:
+                raise AssertionError('attempt to compare two table values')
+            return is_true(self.call_metamethod(handler, [x, y]))
+        return x < y
+
+    def less_equal(self, x, y):
+        # x <= y, with the __le metamethod for tables, or else not y < x
+        # with __lt
+        if isinstance(x, LuaTable) and isinstance(y, LuaTable):
+            handler = self.compare_handler(x, y, '__le')
+            if handler is not None:
+                return is_true(self.call_metamethod(handler, [x, y]))
+            handler = self.compare_handler(x, y, '__lt')
+            if handler is None:
+                raise AssertionError('attempt to compare two table values')
+            return not is_true(self.call_metamethod(handler, [y, x]))
+        return x <= y
+
+    def call_handler(self, a, nargs):
+        # for a call of the value in r[a], which is not a function: puts
+        # its __call metamethod in r[a], moving the nargs arguments up to
+        # make the value the first, and returns the metamethod
+        stack = self.stack
+        start = self.base + a
+        value = stack[start]
+        handler = self.metamethod(value, '__call')
+        if handler is None:
+            raise AssertionError('attempt to call a %s value' %
+                                 library.lua_type([value])[0])
+        self.ensure_stack(start + nargs + 2)
+        stack[start+2:start+nargs+2] = stack[start+1:start+nargs+1]
+        stack[start+1] = value
+        stack[start] = handler
+        return handler
+
+    def call_function(self, function, args):
+        """ Calls function with args and returns the list of its results.
+        A lua function is run to the end by a main loop of its own, as is
+        needed for metamethods, whose results an instruction needs before
+        it can go on.
+        """
+        if isinstance(function, LuaTable):
+            handler = self.metamethod(function, '__call')
+            if handler is None:
+                raise AssertionError('attempt to call a table value')
+            return self.call_function(handler, [function] + args)
+        if type(function) is not LuaClosure:
+            return function(args) or []
+        depth = self.depth
+        tos = self.tos
+        base = self.frame_top() + 1
+        self.ensure_stack(base + len(args))
+        self.stack[base:base+len(args)] = args
+        # the results go to the slot below the arguments, and on
+        call_a = base - 1 - self.base
+        self.enter(function, base, len(args), call_a, 0)
+        while self.depth > depth:
+            self.pc += 1
+            inst = self.function.instructions[self.pc]
+            self.op_functions[inst & 0x0000003f](inst)
+        start = self.base + call_a
+        results = self.stack[start:start+self.tos-call_a]
+        self.tos = tos
+        return results
+
+    def enter(self, closure, base, nargs, call_a, call_c):
+        """ Saves the current frame and starts the lua function closure,
+        whose nargs arguments are on the stack from base.  Its results go
+        to r[call_a] onwards, as for a CALL with c = call_c.
+        """
+        if self.depth == len(self.frames):
+            self.frames.append(Frame())
+        frame = self.frames[self.depth]
+        frame.function = self.function
+        frame.base = self.base
+        frame.start = self.start
+        frame.num_varargs = self.num_varargs
+        frame.tos = self.tos
+        frame.upvalues = self.upvalues
+        frame.pc = self.pc
+        frame.call_a = call_a
+        frame.call_c = call_c
+        self.depth += 1
+        self.setup(closure, base, nargs)
+
+    def setup(self, closure, base, nargs):
+        # makes closure the current function, with its nargs arguments
+        # on the stack from base
+        function = closure.prototype
+        stack = self.stack
+        start = base
+        num_parameters = function.num_parameters
+        num_varargs = 0
+        if function.is_vararg_flag & 0x2:
+            # keep the extra arguments below the registers, where vararg
+            # finds them, and move the parameters up above them
+            num_varargs = max(nargs - num_parameters, 0)
+            if num_varargs:
+                self.ensure_stack(base + nargs + function.max_stack_size)
+                stack[base+nargs:base+nargs+num_parameters] = \
+                    stack[base:base+num_parameters]
+                base += nargs
+                nargs = num_parameters
+        max_stack_size = function.max_stack_size
+        self.ensure_stack(base + max_stack_size)
+        # missing parameters, and registers that aren't parameters, are nil
+        first = min(nargs, num_parameters)
+        if first < max_stack_size:
+            stack[base+first:base+max_stack_size] = \
+                [None] * (max_stack_size - first)
+        if function.is_vararg_flag & 0x4:
+            # lua 5.0 style 'arg' table of the extra arguments
+            arg_array = stack[base-num_varargs:base]
+            stack[base+num_parameters] = LuaTable(
+                array=arg_array, hash={'n': len(arg_array)})
+        self.function = function
+        self.base = base
+        self.start = start
+        self.num_varargs = num_varargs
+        self.tos = function.max_stack_size
+        self.upvalues = closure.upvalues
+        self.pc = -1
+
+    def ensure_stack(self, size):
+        # grows the value stack to at least size slots, doubling it so
+        # that growing it is rare
+        stack = self.stack
+        if size > len(stack):
+            grow = max(size - len(stack), len(stack))
+            stack.extend([None] * grow)
+
+    def frame_top(self):
+        # the stack slot after the last register of the current function
+        return self.base + max(self.tos, self.function.max_stack_size)
+
+    def find_upvalue(self, index):
+        # returns the open upvalue for the register at stack slot index,
+        # making one if it has not been captured yet
+        open_upvalues = self.open_upvalues
+        i = len(open_upvalues)
+        while i > 0 and open_upvalues[i-1].index >= index:
+            if open_upvalues[i-1].index == index:
+                return open_upvalues[i-1]
+            i -= 1
+        upvalue = LuaValue(None, index)
+        open_upvalues.insert(i, upvalue)
+        return upvalue
+
+    def close_upvalues(self, level):
+        # closes the open upvalues of registers from stack slot level up,
+        # so the registers can be reused
+        open_upvalues = self.open_upvalues
+        while open_upvalues and open_upvalues[-1].index >= level:
+            upvalue = open_upvalues.pop()
+            upvalue.value = self.stack[upvalue.index]
+            upvalue.index = -1
 
     def rk(self, o):
         # returns unwrapped value
         if o & 256:
             return self.function.constants[o-256].value
         else:
-            return self.registers[o].value
+            return self.stack[self.base+o]
+
+    def traced(self, opcode):
+        """ Returns the handler for opcode wrapped to trace each
+        instruction it runs.
+        """
+        op_function = self.op_functions[opcode]
+        def traced_op_function(inst):
+            pc = self.pc
+            # CALL replaces the function in r[a] with its results
+            ra = self.stack[self.base + ((inst >> 6) & 0x000000ff)]
+            op_function(inst)
+            self.trace_inst(opcode, inst, pc, ra)
+        return traced_op_function
+
+    def where(self):
+        """ Returns the chunk and source line of the instruction being run,
+        as 'chunk:line', the way lua starts its error messages.  The line
+        is decoded from the bytecode if it was loaded without debug info.
+        """
+        function = self.function
+        # luac only keeps the name of the chunk in its main function
+        source = function.sourcename or self.top_level_func.sourcename
+        if source[:1] in ('@', '='):
+            source = source[1:]
+        else:
+            source = '[string "%s"]' % source.split('\n')[0]
+        return '%s:%d' % (source, function.get_line(self.pc))
+
+    def trace_inst(self, opcode, inst, pc, ra):
+        """ Works out what to show for an instruction that just ran, and
+        passes it on to trace.  pc is the program counter and ra the value
+        in r[a] from before it ran.
+        """
+        name, operand_format, writes_a = OPCODES[opcode]
+        a, b, c = self.getabc(inst)
+        if operand_format == 'abc':
+            operands = [a, b, c]
+        elif operand_format == 'ab':
+            operands = [a, b]
+        elif operand_format == 'ac':
+            operands = [a, c]
+        elif operand_format == 'a':
+            operands = [a]
+        elif operand_format == 'abx':
+            operands = list(self.getabx(inst))
+        elif operand_format == 'asbx':
+            operands = list(self.getasbx(inst))
+        else:
+            operands = [self.getasbx(inst)[1]]
+        registers = [a] if writes_a else []
+        print_hr = False
+        if name == 'LOADNIL':
+            registers = range(a, b+1)
+        elif name == 'SELF':
+            registers = [a+1, a]
+        elif name == 'TESTSET':
+            registers = [a] if self.stack[self.base+b] == c else []
+        elif name == 'CALL':
+            print_hr = type(ra) is LuaClosure
+            if not print_hr:
+                if c == 0:
+                    registers = range(a, self.tos - a)
+                elif c >= 2:
+                    registers = range(a, c-1)
+        elif name == 'RETURN':
+            if self.done:
+                return
+            print_hr = True
+        elif name == 'FORLOOP':
+            registers = [a+3] if self.pc != pc else []
+        elif name == 'TFORLOOP':
+            registers = range(a+3, a+3+c)
+            if self.stack[self.base+a+3] is not None:
+                registers.append(a+2)
+        elif name == 'SETLIST':
+            if c == 0:
+                # c was read from the next instruction
+                operands[2] = self.function.instructions[self.pc]
+        elif name == 'VARARG':
+            registers = range(a, self.tos if b == 0 else a+b-1)
+        self.trace(name, operands, registers, print_hr)
 
     def trace(self, instruction, operands, registers, print_hr=False):
         """ Print trace of an instruction, showing what instruction
@@ -530,15 +1268,13 @@ class Interpreter:
             print_hr - If true, prints a horizontal rule after the trace,
                 to separate instructions from different function calls
         """
-        if not self.print_trace:
-            return
-        indent = ' ' * len(self.stack) * 2
+        indent = ' ' * self.depth * 2
         if instruction == 'CALL' and print_hr:
             indent = indent[2:]
         elif instruction == 'RETURN':
             indent = '  ' + indent
         reg_values = [repr(r) if isinstance(r, str) else r
-                      for r in [self.registers[x].value for x in registers]]
+                      for r in [self.stack[self.base+x] for x in registers]]
         regstr = ' '.join(['r[{}]={}'.format(x, r)
                            for (x, r) in zip(registers, reg_values)])
         op0 = operands[0] if len(operands) > 0 else ''
@@ -550,35 +1286,77 @@ class Interpreter:
             print '-' * 60
 
     def reg_str(self):
-        return str([r.value for r in self.registers])
+        return str(self.stack[self.base:self.frame_top()])
 
 def entry_point(argv):
+    import sys
     import parser
-    import os
     trace = False
     if '--trace' in argv:
         trace=True
         argv.remove('--trace')
-    if len(argv) < 2:
-        print 'usage: interpreter.py [--trace] lua-file'
+    checked = False
+    if '--checked' in argv:
+        checked = True
+        argv.remove('--checked')
+    compile = False
+    if '--compile' in argv:
+        compile = True
+        argv.remove('--compile')
+    fuse = None
+    if '--fuse' in argv:
+        fuse = superinst.DEFAULT_PAIRS
+        argv.remove('--fuse')
+    adaptive = True
+    if '--no-quicken' in argv:
+        adaptive = False
+        argv.remove('--no-quicken')
+    lazy = False
+    if '--lazy' in argv:
+        lazy = True
+        argv.remove('--lazy')
+    debug_info = True
+    if '--no-debug' in argv:
+        debug_info = False
+        argv.remove('--no-debug')
+    chunk_cache = None
+    if '--cache' in argv:
+        import chunkcache
+        chunk_cache = chunkcache.ChunkCache(chunkcache.default_directory())
+        argv.remove('--cache')
+    cache_stats = False
+    if '--cache-stats' in argv:
+        cache_stats = True
+        argv.remove('--cache-stats')
+    if len(argv) < 2 or (chunk_cache is not None and (lazy or not debug_info)):
+        # the cache holds whole chunks with their debug info
+        print 'usage: interpreter.py [--trace] [--checked] [--compile] ' \
+            '[--fuse] [--no-quicken] [--lazy] [--no-debug] ' \
+            '[--cache [--cache-stats]] lua-file'
+        print '--cache cannot be combined with --lazy or --no-debug'
         exit(1)
     filename = argv[1]
-    if filename.endswith('.lua'):
-        # file is a lua script, compile with luac first
-        import subprocess
-        subprocess.Popen(['luac', '-o', filename + 'c', filename])
-        filename += 'c'
-    bcfile = os.open(filename, os.O_RDONLY, 0777)
-    bytecode = ""
-    while True:
-        read = os.read(bcfile, 4096)
-        if len(read) == 0:
-            break
-        bytecode += read
-    os.close(bcfile)    
-    lua_bytecode = parser.LuaBytecode(bytecode)
-    interpreter = Interpreter(lua_bytecode, argv[1:], trace)
-    interpreter.run()
+    if chunk_cache is not None:
+        lua_bytecode = chunk_cache.load(filename)
+        if cache_stats:
+            chunk_cache.print_stats()
+    else:
+        if filename.endswith('.lua'):
+            # file is a lua script, compile with luac first
+            parser.compile_lua(filename)
+            filename += 'c'
+        lua_bytecode = parser.load_file(filename, lazy, debug_info)
+    interpreter = Interpreter(lua_bytecode, argv[1:], trace, checked,
+                              compile, fuse, adaptive)
+    try:
+        interpreter.run()
+    except AssertionError, e:
+        # a lua error, unless the interpreter itself is being debugged
+        if checked or trace:
+            raise
+        sys.stdout.flush()
+        sys.stderr.write('lua: %s: %s\n' % (interpreter.where(), e))
+        exit(1)
 
 def target(*args):
     return entry_point, None
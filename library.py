@@ -32,26 +32,33 @@ def lua_getfenv(args):
 
 def lua_getmetatable(args):
     object = args[0]
-    metatable = object.metatable
-    if metatable and '__metatable' in metatable.hash:
-        return [metatable['__metatable']]
+    if isinstance(object, str):
+        metatable = string_metatable
+    elif isinstance(object, LuaTable):
+        metatable = object.metatable
+    else:
+        metatable = None
+    if metatable is not None and metatable.get('__metatable') is not None:
+        return [metatable.get('__metatable')]
     else:
         return [metatable]
 
+def ipairs_next(args):
+    # the iterator ipairs returns, which the interpreter's TFORLOOP also
+    # knows to run without calling it
+    table = args[0]
+    index = args[1]
+    assert isinstance(index, (int, long, float))
+    assert int(index) == index
+    index = int(index) + 1
+    value = table.get(index)
+    if value is None:
+        return [None]
+    return [index, value]
+
 def lua_ipairs(args):
     t = args[0]
-    def iter_func(args):
-        table = args[0]
-        index = args[1]
-        assert isinstance(index, (int, long, float))
-        assert int(index) == index
-        index = int(index)
-        if index < len(table):
-            nextindex = index + 1
-            return [nextindex, table[nextindex]]
-        else:
-            return [None]
-    return [iter_func, t, 0]
+    return [ipairs_next, t, 0]
 
 def lua_load(args):
     raise AssertionError('load NYI')
@@ -65,32 +72,10 @@ def lua_loadstring(args):
 def lua_next(args):
     table = args[0]
     index = args[1] if len(args) > 1 else None
-    if index:
-        if isinstance(index, (int, long, float)) \
-            and int(index) == index \
-            and index > 0:
-            # index is array index
-            index = int(index)
-            if index < len(table):
-                nextindex = index + 1
-                return [nextindex, table[nextindex]]
-            elif index == len(table):
-                # last array index, so return first index and element in hash
-                key = table.hash.keys()[0]
-                return [key, table[key]]
-        # otherwise index is hash key
-        keys = table.hash.keys()
-        i = keys.index(index)
-        if i < len(keys) - 1:
-            nextkey = keys[i+1]
-            return [nextkey, table[nextkey]]
-    else:
-        if table.array:
-            return [1, table[1]]
-        elif table.hash:
-            key = table.hash.keys()[0]
-            return [key, table[key]]
-    return [None]
+    key, value = table.next(index)
+    if key is None:
+        return [None]
+    return [key, value]
 
 def lua_pairs(args):
     t = args[0]
@@ -112,10 +97,15 @@ def lua_rawequal(args):
     raise AssertionError('rawequal NYI')
 
 def lua_rawget(args):
-    raise AssertionError('rawget NYI')
+    table = args[0]
+    assert isinstance(table, LuaTable)
+    return [table.get(args[1])]
 
 def lua_rawset(args):
-    raise AssertionError('rawset NYI')
+    table = args[0]
+    assert isinstance(table, LuaTable)
+    table.set(args[1], args[2])
+    return [table]
 
 def lua_select(args):
     index = args[0]
@@ -130,9 +120,9 @@ def lua_setfenv(args):
 def lua_setmetatable(args):
     table = args[0]
     metatable = args[1]
-    if table.metatable and '__metatable' in table.metatable.hash:
+    if table.metatable and table.metatable.get('__metatable') is not None:
         raise AssertionError('table has a "__metatable" field')
-    table.metatable = metatable
+    table.set_metatable(metatable)
     return [table]
 
 def lua_tonumber(args):
@@ -164,7 +154,7 @@ def lua_type(args):
         return ['boolean']
     if isinstance(v, LuaTable):
         return ['table']
-    if isinstance(v, LuaFunction) or hasattr(v, '__call__'):
+    if isinstance(v, LuaClosure) or hasattr(v, '__call__'):
         return ['function']
     # TODO check if thread or userdata
     return ['thread or userdata']
@@ -172,9 +162,12 @@ def lua_type(args):
 def lua_unpack(args):
     list = args[0]
     assert isinstance(list, LuaTable)
-    i = args[1] if len(args) > 1 else 1
-    j = args[2] if len(args) > 2 else len(list)
-    return [t[k] for k in xrange(i, j+1)]
+    i = int(args[1]) if len(args) > 1 and args[1] is not None else 1
+    j = int(args[2]) if len(args) > 2 and args[2] is not None \
+        else list.length()
+    if 0 < i and j <= len(list.array):
+        return [value for value in list.array[i-1:j]]
+    return [list.get(k) for k in xrange(i, j+1)]
 
 _VERSION = 'Lua 5.1'
 
@@ -286,7 +279,7 @@ def string_match(args):
 def string_rep(args):
     s = args[0]
     n = args[1]
-    return [s * n]
+    return [s * int(n)]
 
 def string_reverse(args):
     s = args[0]
@@ -327,37 +320,49 @@ lua_string = LuaTable(hash={
     'upper': string_upper,
     })
 
+# the metatable all strings share, so that s:upper() calls string.upper
+string_metatable = LuaTable(hash={'__index': lua_string})
+
 # table library
 
 def table_concat(args):
     lenargs = len(args)
     table = args[0]
     sep = args[1] if lenargs > 1 else ''
-    i = args[2] if lenargs > 2 else 1
-    j = args[3] if lenargs > 3 else len(table)
-    return [sep.join([str(table[k]) for k in xrange(i, j+1)])]
+    i = int(args[2]) if lenargs > 2 else 1
+    j = int(args[3]) if lenargs > 3 else table.length()
+    return [sep.join([str(table.get(k)) for k in xrange(i, j+1)])]
 
 def table_insert(args):
     table = args[0]
-    pos = args[1] if len(args) > 2 else len(table)+1
+    pos = int(args[1]) if len(args) > 2 else table.length() + 1
     value = args[2] if len(args) > 2 else args[1]
-    table.array.insert(pos-1, value)
+    table.insert(pos, value)
     return []
 
 def table_maxn(args):
+    # the largest positive number key, which unlike the length has to
+    # look at every key outside the array part
     table = args[0]
-    i = len(table)
-    while i > 0:
-        if table[i] != None:
-            return [i]
-        i -= 1
-    return [0]
+    array = table.array
+    n = len(array)
+    while n > 0 and array[n-1] is None:
+        n -= 1
+    for key, value in zip(table.hash_keys, table.hash_values):
+        if type(key) in (int, long, float) and key > n and \
+                value is not None:
+            n = key
+    return [n]
 
 def table_remove(args):
     table = args[0]
-    pos = args[1] if len(args) > 1 else len(table)
-    del table[pos]
-    return []
+    n = table.length()
+    if n == 0:
+        return []
+    pos = int(args[1]) if len(args) > 1 else n
+    if not 1 <= pos <= n:
+        return []
+    return [table.remove(pos)]
 
 def table_sort(args):
     raise AssertionError('table.sort NYI')
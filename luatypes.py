@@ -1,41 +1,595 @@
-class LuaTable:
-    def __init__(self, array=None, hash=None):
-        self.array = array or []
-        self.hash = hash or {}
+from array import array as typed_array
+
+# tables with more string keys than this keep them in their hash part,
+# as they are likely used as dictionaries rather than records
+MAX_SHAPE_FIELDS = 64
+# keys above 2**MAX_ARRAY_BITS are always kept in the hash part, as in lua
+MAX_ARRAY_BITS = 26
+# the smallest hash part that is rehashed when it grows
+MIN_REHASH = 8
+
+class Shape:
+    """ The string keys of a table used as a record, in the order they
+    were first set, with the slot of each in the table's fields.  Tables
+    that had the same keys set in the same order share a Shape, and
+    setting a new key moves a table on to the shape that has it as well
+    (see with_key).  A shape never changes once made, so the slot of a
+    key in a shape can be cached for all tables that have that shape.
+    Watched tables (see LuaTable.watch) have shapes of their own, with
+    watched set, which are never cached for SETTABLE.
+    """
+    def __init__(self, slots, keys, watched=False):
+        # key -> slot
+        self.slots = slots
+        # key of each slot
+        self.keys = keys
+        self.watched = watched
+        # new key -> shape with it added
+        self.transitions = {}
+        # the shape with the same keys and watched set
+        self.twin = None
+
+    def with_key(self, key):
+        shape = self.transitions.get(key)
+        if shape is None:
+            slots = self.slots.copy()
+            slots[key] = len(self.keys)
+            shape = Shape(slots, self.keys + [key], self.watched)
+            self.transitions[key] = shape
+        return shape
+
+    def watched_shape(self):
+        if self.watched:
+            return self
+        if self.twin is None:
+            self.twin = Shape(self.slots, self.keys, True)
+        return self.twin
+
+# the shape of tables with no string keys
+EMPTY_SHAPE = Shape({}, [])
+# the shape of tables that keep their string keys in their hash part,
+# which has no slots
+DICT_SHAPE = Shape({}, [])
+
+# what tables share for their array part, fields and hash lists while
+# those are empty, and for their hash dict, which is never changed, so
+# that a part is only allocated once something is put in it
+EMPTY_PART = ()
+EMPTY_HASH = {}
+
+def array_part(values):
+    """ Returns the storage for an array part that holds the list
+    values: an array of doubles if they are all floats, which takes
+    8 bytes a value instead of a float object each, and which the garbage
+    collector doesn't need to look inside, or else the list itself.
+    Ints stay in lists, as they print differently.
+    """
+    if not values:
+        return EMPTY_PART
+    for value in values:
+        if type(value) is not float:
+            return values
+    return typed_array('d', values)
+
+class LuaTable(object):
+    """ A lua table.  Values with positive integer keys are kept in the
+    array, for keys 1 to len(array), as long as more than half of the
+    keys it would then have are in use (see rehash), and in the hash
+    part otherwise.  array is an array of doubles while all its values
+    are floats, and a list otherwise (see array_part).  Values with
+    string keys are kept in the list fields, at the slot their key has
+    in shape, until the table has more than MAX_SHAPE_FIELDS of them,
+    after which its shape is DICT_SHAPE and they are kept in the hash
+    part along with all other keys.  The hash part is the lists
+    hash_keys and hash_values, in the order the keys were added, and
+    the dict hash, which gives the position of each key in them (see
+    set_in_hash).  Parts that are empty are EMPTY_PART or EMPTY_HASH.
+    """
+    __slots__ = ('array', 'hash', 'hash_keys', 'hash_values', 'shape',
+                 'fields', 'metatable', 'watched')
+
+    # set to a number it has not had before whenever a watched table
+    # changes, see watch
+    watched_version = 0
+
+    def __init__(self, array=None, hash=None, hash_size=0):
+        self.array = array or EMPTY_PART
+        self.hash = EMPTY_HASH
+        self.hash_keys = EMPTY_PART
+        self.hash_values = EMPTY_PART
+        # a table made to have more keys outside its array part than a
+        # record can is a dictionary from the start
+        if hash_size > MAX_SHAPE_FIELDS:
+            self.shape = DICT_SHAPE
+        else:
+            self.shape = EMPTY_SHAPE
+        self.fields = EMPTY_PART
         self.metatable = None
+        self.watched = False
+        if hash:
+            for key in hash:
+                self.set(key, hash[key])
 
     def get(self, key):
-        if isinstance(key, (int, long, float)) and int(key) == key and key > 0:
-            key = int(key)
-            return self.array[key-1] if len(self.array) >= key else None
-        else:
-            return self.hash[key] if key in self.hash else None
+        t = type(key)
+        if t is str:
+            slot = self.shape.slots.get(key, -1)
+            if slot >= 0:
+                return self.fields[slot]
+        elif t is float or t is int or t is long:
+            i = int(key)
+            if i == key and 0 < i <= len(self.array):
+                return self.array[i-1]
+        # integral floats find the int keys they are equal to in hash
+        pos = self.hash.get(key)
+        if pos is None:
+            return None
+        return self.hash_values[pos]
 
     def set(self, key, value):
-        if isinstance(key, (int, long, float)) and int(key) == key and key > 0:
-            key = int(key)
-            while key > len(self.array):
-                self.array.append(None)
-            self.array[key-1] = value
+        if self.watched and self.get(key) is not value:
+            LuaTable.watched_version += 1
+        t = type(key)
+        if t is str:
+            shape = self.shape
+            slot = shape.slots.get(key, -1)
+            if slot >= 0:
+                self.fields[slot] = value
+            elif shape is DICT_SHAPE:
+                self.set_in_hash(key, value)
+            elif len(self.fields) < MAX_SHAPE_FIELDS:
+                self.shape = shape.with_key(key)
+                self.add_field(value)
+            else:
+                # too many to be a record, so move them all to the hash
+                fields = self.fields
+                self.shape = DICT_SHAPE
+                self.fields = EMPTY_PART
+                for k in shape.keys:
+                    self.set_in_hash(k, fields[shape.slots[k]])
+                self.set_in_hash(key, value)
+        elif t is float or t is int or t is long:
+            array = self.array
+            i = int(key)
+            if i != key or i <= 0:
+                self.set_in_hash(key, value)
+            elif i <= len(array):
+                if type(value) is not float and type(array) is not list:
+                    array = self.generalize()
+                array[i-1] = value
+            elif i == len(array) + 1 and value is not None:
+                if type(value) is float:
+                    if not array:
+                        # the first value decides the strategy
+                        self.array = array = typed_array('d')
+                elif type(array) is not list:
+                    array = self.generalize()
+                if self.hash:
+                    # a key lives in one part only
+                    self.pop_from_hash(i)
+                array.append(value)
+                if self.hash:
+                    self.take_from_hash()
+            else:
+                self.set_in_hash(i, value)
         else:
-            self.hash[key] = value
+            self.set_in_hash(key, value)
+
+    def add_field(self, value):
+        """ Adds value as the field in the slot after the last, for a key
+        the table's shape has just been moved on to have.
+        """
+        if self.fields:
+            self.fields.append(value)
+        else:
+            self.fields = [value]
+
+    def take_from_hash(self):
+        # moves the keys right after the array part from the hash part
+        # onto it, once the array part has grown up to them
+        array = self.array
+        while True:
+            value = self.pop_from_hash(len(array) + 1)
+            if value is None:
+                return
+            if type(value) is not float and type(array) is not list:
+                array = self.generalize()
+            array.append(value)
+
+    def generalize(self):
+        # switches the array part to a list, which can hold any value,
+        # and returns it
+        self.array = list(self.array)
+        return self.array
+
+    def insert(self, i, value):
+        """ Inserts value at key i, moving the values from there up to
+        the length of the table up by one, as table.insert does.
+        """
+        n = self.length()
+        array = self.array
+        if 0 < i <= n == len(array) and value is not None:
+            if self.watched:
+                LuaTable.watched_version += 1
+            if type(value) is not float and type(array) is not list:
+                array = self.generalize()
+            array.insert(int(i) - 1, value)
+            if self.hash:
+                self.take_from_hash()
+        else:
+            for k in xrange(n, int(i) - 1, -1):
+                self.set(k + 1, self.get(k))
+            self.set(i, value)
+
+    def remove(self, i):
+        """ Removes the value at key i, for i from 1 to the length of the
+        table, and returns it, moving the values after it down by one, as
+        table.remove does.
+        """
+        n = self.length()
+        array = self.array
+        if n == len(array):
+            if self.watched:
+                LuaTable.watched_version += 1
+            return array.pop(int(i) - 1)
+        value = self.get(i)
+        for k in xrange(int(i), n):
+            self.set(k, self.get(k + 1))
+        self.set(n, None)
+        return value
+
+    def length(self):
+        """ Returns a border of the table, which is what lua's # gives: a
+        key n that is 0 or has a value, such that n+1 has none.  Like
+        lua's, it is found by a binary search of the array part when it
+        ends with nil, and otherwise by probing the hash part at the
+        keys after it, doubling each time, and then a binary search.
+        Either way it takes O(log n), and O(1) when the array part ends
+        the sequence, as it does when appending with t[#t+1].
+        """
+        array = self.array
+        j = len(array)
+        if j > 0 and array[j-1] is None:
+            # array[i-1] is non-nil, or i is 0, and array[j-1] is nil
+            i = 0
+            while j - i > 1:
+                m = (i + j) / 2
+                if array[m-1] is None:
+                    j = m
+                else:
+                    i = m
+            return i
+        if not self.hash:
+            return j
+        hash = self.hash
+        values = self.hash_values
+        # key i has a value, or is len(array), and key j has none
+        i = j
+        j += 1
+        while True:
+            pos = hash.get(j)
+            if pos is None or values[pos] is None:
+                break
+            i = j
+            j *= 2
+        while j - i > 1:
+            m = (i + j) / 2
+            pos = hash.get(m)
+            if pos is None or values[pos] is None:
+                j = m
+            else:
+                i = m
+        return i
+
+    def set_list(self, offset, values):
+        """ Sets keys offset+1 onwards to values, as SETLIST does for a
+        table constructor, with one slice assignment into the array part
+        when they are in it or go on from its end.
+        """
+        array = self.array
+        n = len(array)
+        end = offset + len(values)
+        if not array:
+            self.array = array = []
+        if offset > n or self.watched:
+            for i in xrange(len(values)):
+                self.set(offset + 1 + i, values[i])
+            return
+        if type(array) is not list:
+            for value in values:
+                if type(value) is not float:
+                    array = self.generalize()
+                    break
+            else:
+                values = typed_array('d', values)
+        if self.hash:
+            # keys the array part grows over are no longer in the hash
+            for i in xrange(n + 1, end + 1):
+                self.pop_from_hash(i)
+        array[offset:end] = values
+        if end >= n:
+            if type(array) is list:
+                # the first values set decide the strategy, see set
+                self.array = array = array_part(array)
+            if self.hash:
+                self.take_from_hash()
+
+    def set_in_hash(self, key, value):
+        """ Sets key in the hash part.  A new key goes after all the
+        others, and a key set to nil keeps its place, so that next can
+        go on from it.  The places of keys that are nil are only given up
+        when the hash part grows to a power of two and is rehashed,
+        which is when lua's would be full.
+        """
+        pos = self.hash.get(key)
+        if pos is not None:
+            self.hash_values[pos] = value
+        elif value is not None:
+            self.add_to_hash(key, value)
+            n = len(self.hash_keys)
+            if n >= MIN_REHASH and n & (n - 1) == 0:
+                self.rehash()
+
+    def pop_from_hash(self, key):
+        # removes key from the hash part, returning its value
+        pos = self.hash.pop(key, None)
+        if pos is None:
+            return None
+        value = self.hash_values[pos]
+        self.hash_values[pos] = None
+        return value
+
+    def rehash(self):
+        """ Resizes the array part the way lua does, to the largest power
+        of two n for which more than half of the keys 1 to n are in use,
+        but only as far as the last of those keys that is in use.  Keys
+        it then has are moved to it from the hash part, and keys past it
+        are moved to the hash part, which loses the keys that are nil.
+        """
+        array = self.array
+        keys = self.hash_keys
+        values = self.hash_values
+        # nums[b] is how many keys from 2**(b-1)+1 to 2**b are in use
+        nums = [0] * (MAX_ARRAY_BITS + 1)
+        for i in xrange(len(array)):
+            if array[i] is not None:
+                nums[i.bit_length()] += 1
+        for pos in xrange(len(keys)):
+            key = keys[pos]
+            t = type(key)
+            if (t is float or t is int or t is long) and \
+                    values[pos] is not None:
+                i = int(key)
+                if i == key and 0 < i <= 1 << MAX_ARRAY_BITS:
+                    nums[(i-1).bit_length()] += 1
+        size = 0
+        count = 0
+        for b in xrange(MAX_ARRAY_BITS + 1):
+            count += nums[b]
+            if count > (1 << b) / 2:
+                size = 1 << b
+        items = list(array)
+        moved = []
+        if size > len(array):
+            for i in xrange(len(array) + 1, size + 1):
+                items.append(self.pop_from_hash(i))
+        elif size < len(array):
+            for i in xrange(size, len(array)):
+                if array[i] is not None:
+                    moved.append((i + 1, array[i]))
+            del items[size:]
+        while items and items[-1] is None:
+            items.pop()
+        self.array = array_part(items)
+        self.hash = EMPTY_HASH
+        self.hash_keys = EMPTY_PART
+        self.hash_values = EMPTY_PART
+        for pos in xrange(len(keys)):
+            if values[pos] is not None:
+                self.add_to_hash(keys[pos], values[pos])
+        for key, value in moved:
+            self.add_to_hash(key, value)
+
+    def add_to_hash(self, key, value):
+        # adds a key that is not in the hash part, without rehashing
+        if not self.hash_keys:
+            self.hash = {}
+            self.hash_keys = []
+            self.hash_values = []
+        self.hash[key] = len(self.hash_keys)
+        self.hash_keys.append(key)
+        self.hash_values.append(value)
+
+    def set_metatable(self, metatable):
+        if self.watched and metatable is not self.metatable:
+            LuaTable.watched_version += 1
+        self.metatable = metatable
+
+    def watch(self):
+        """ Makes every later change to the table, or to which metatable
+        it has, change LuaTable.watched_version, so that what was found
+        by looking through the table stays right for as long as
+        watched_version doesn't change.  Used for the metatables and
+        __index tables that lookups go through.  The table moves on to a
+        watched shape, so that SETTABLE never writes to it directly.
+        """
+        if not self.watched:
+            self.watched = True
+            if self.shape is not DICT_SHAPE:
+                self.shape = self.shape.watched_shape()
+
+    def next(self, key):
+        """ Returns the key that comes after key in the table, and its
+        value, as lua's next does, or (None, None) after the last one.
+        Keys whose value is nil are skipped.  The array part comes first,
+        then the fields in the order their keys were first set, then the
+        hash part in the order its keys were added, so that each step
+        goes on from where key is, and setting the value of keys that
+        are already in the table doesn't change the order.
+        """
+        array = self.array
+        fields = self.fields
+        values = self.hash_values
+        # where to go on from in each part
+        i = j = k = 0
+        if key is not None:
+            # a key in the hash part goes on from there, so that the
+            # walk always moves forward
+            pos = self.hash.get(key) if self.hash else None
+            t = type(key)
+            n = 0
+            if t is float or t is int or t is long:
+                n = int(key)
+            if pos is not None:
+                i = len(array)
+                j = len(fields)
+                k = pos + 1
+            elif n == key and 0 < n <= len(array):
+                i = n
+            else:
+                i = len(array)
+                slot = -1
+                if t is str:
+                    slot = self.shape.slots.get(key, -1)
+                if slot < 0:
+                    raise AssertionError("invalid key to 'next'")
+                j = slot + 1
+        while i < len(array):
+            value = array[i]
+            i += 1
+            if value is not None:
+                return i, value
+        while j < len(fields):
+            value = fields[j]
+            j += 1
+            if value is not None:
+                return self.shape.keys[j-1], value
+        while k < len(values):
+            value = values[k]
+            k += 1
+            if value is not None:
+                return self.hash_keys[k-1], value
+        return None, None
+
+    def hash_part(self):
+        # all keys that are not in array, with their values
+        hash = dict(zip(self.hash_keys, self.hash_values))
+        for key in self.shape.keys:
+            hash[key] = self.fields[self.shape.slots[key]]
+        return hash
 
     def __str__(self):
         return 'LuaTable #array={} #hash={}'.format(
-            len(self.array), len(self.hash))
+            len(self.array), len(self.hash) + len(self.fields))
 
     def __repr__(self):
-        return 'LuaTable(array={}, hash={})'.format(self.array, self.hash)
+        return 'LuaTable(array={}, hash={})'.format(self.array,
+                                                    self.hash_part())
 
     def __len__(self):
-        return len(self.array)
+        return self.length()
+
+class GlobalTable(LuaTable):
+    """ The table of global variables.  Values with string keys are kept
+    in values, at the index slots gives for the key, and a key keeps its
+    slot for good once it has one.  Slot 0 is never given out and always
+    holds nil, so it is the slot of every missing key.  version is set
+    to a number no table has had before whenever a key gets a slot, so a
+    slot looked up for a key stays right for as long as version doesn't
+    change.  names has the key of each slot.
+    """
+    last_version = 0
 
-class LuaValue:
-    def __init__(self, value):
-        # the internal value
+    def __init__(self, hash=None):
+        LuaTable.__init__(self)
+        self.slots = {}
+        self.values = [None]
+        self.names = [None]
+        self.new_version()
+        if hash:
+            for key in hash:
+                self.set(key, hash[key])
+
+    def new_version(self):
+        GlobalTable.last_version += 1
+        self.version = GlobalTable.last_version
+
+    def slot(self, key):
+        return self.slots.get(key, 0)
+
+    def get(self, key):
+        if isinstance(key, str):
+            return self.values[self.slots.get(key, 0)]
+        return LuaTable.get(self, key)
+
+    def set(self, key, value):
+        if isinstance(key, str):
+            slot = self.slots.get(key, 0)
+            if slot == 0:
+                self.slots[key] = len(self.values)
+                self.values.append(value)
+                self.names.append(key)
+                self.new_version()
+            else:
+                self.values[slot] = value
+        else:
+            LuaTable.set(self, key, value)
+
+    def next(self, key):
+        # the keys of the other parts come first, then those with slots
+        if isinstance(key, str):
+            slot = self.slots.get(key, 0)
+            if slot == 0:
+                raise AssertionError("invalid key to 'next'")
+            slot += 1
+        else:
+            key, value = LuaTable.next(self, key)
+            if key is not None:
+                return key, value
+            slot = 1
+        values = self.values
+        while slot < len(values):
+            if values[slot] is not None:
+                return self.names[slot], values[slot]
+            slot += 1
+        return None, None
+
+class LuaValue(object):
+    """ An upvalue: a variable captured by closures.  While it is open,
+    the variable is still the register at index in the interpreter's
+    value stack; once closed, index is -1 and the cell holds its value.
+    """
+    __slots__ = ('value', 'index')
+
+    def __init__(self, value, index=-1):
+        # the internal value, once closed
         self.value = value
-        # list of (closure, upvalue_index) pairs that reference this
-        # value as an upvalue
-        self.referencing_closures = []
+        # the stack slot of the register, while open
+        self.index = index
     def __repr__(self):
         return 'LuaValue(' + str(self.value) + ')'
+
+def is_true(value):
+    """ Whether value counts as true in lua, where only nil and false
+    don't.
+    """
+    return value is not None and value is not False
+
+def is_function(value):
+    """ Whether value is a lua function or a native one. """
+    return type(value) is LuaClosure or hasattr(value, '__call__')
+
+class LuaClosure(object):
+    """ A lua function value: the function prototype (a LuaFunction from
+    the parser) and the upvalues of this instance of it.  Native library
+    functions are plain Python functions, so type(f) is LuaClosure tells
+    the two apart.
+    """
+    __slots__ = ('prototype', 'upvalues')
+
+    def __init__(self, prototype, upvalues):
+        self.prototype = prototype
+        self.upvalues = upvalues
+
+    def __repr__(self):
+        return repr(self.prototype)
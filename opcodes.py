@@ -0,0 +1,30 @@
+# opcodes: the Lua 5.1 opcodes, in opcode order, followed by the internal
+# ones the interpreter uses for superinstructions (see superinst.py) and
+# quickened instructions (see quicken.py)
+
+(MOVE, LOADK, LOADBOOL, LOADNIL, GETUPVAL, GETGLOBAL, GETTABLE, SETGLOBAL,
+ SETUPVAL, SETTABLE, NEWTABLE, SELF, ADD, SUB, MUL, DIV, MOD, POW, UNM, NOT,
+ LEN, CONCAT, JMP, EQ, LT, LE, TEST, TESTSET, CALL, TAILCALL, RETURN,
+ FORLOOP, FORPREP, TFORLOOP, SETLIST, CLOSE, CLOSURE, VARARG) = range(38)
+
+NUM_OPCODES = 38 # lua opcodes, the internal ones come after them
+
+# name of each opcode, in opcode order, with how trace shows its operands
+# and whether it writes to r[a]
+OPCODES = [
+    ('MOVE', 'ab', True), ('LOADK', 'abx', True), ('LOADBOOL', 'abc', True),
+    ('LOADNIL', 'ab', False), ('GETUPVAL', 'ab', True),
+    ('GETGLOBAL', 'abx', True), ('GETTABLE', 'abc', True),
+    ('SETGLOBAL', 'abx', False), ('SETUPVAL', 'ab', False),
+    ('SETTABLE', 'abc', False), ('NEWTABLE', 'abc', True),
+    ('SELF', 'abc', False), ('ADD', 'abc', True), ('SUB', 'abc', True),
+    ('MUL', 'abc', True), ('DIV', 'abc', True), ('MOD', 'abc', True),
+    ('POW', 'abc', True), ('UNM', 'ab', True), ('NOT', 'ab', True),
+    ('LEN', 'ab', True), ('CONCAT', 'abc', True), ('JMP', 'sbx', False),
+    ('EQ', 'abc', False), ('LT', 'abc', False), ('LE', 'abc', False),
+    ('TEST', 'ac', False), ('TESTSET', 'abc', False), ('CALL', 'abc', False),
+    ('TAILCALL', 'ab', False), ('RETURN', 'ab', False),
+    ('FORLOOP', 'asbx', False), ('FORPREP', 'asbx', True),
+    ('TFORLOOP', 'ac', False), ('SETLIST', 'abc', False),
+    ('CLOSE', 'a', False), ('CLOSURE', 'abx', True), ('VARARG', 'ab', False),
+    ]
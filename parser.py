@@ -1,11 +1,25 @@
 #!/usr/bin/env python
 
+from array import array
+
+# runpack_from and readbytes read a field at an offset of the bytecode
+# without slicing out a copy of it first, so the bytecode may be a
+# string, an mmap or a memoryview.  Under RPython only strings are
+# supported and the fields are sliced out.
 try:
     from rpython.rlib.rstruct.runpack import runpack
+    def runpack_from(fmt, input, offset, size):
+        return runpack(fmt, input[offset:offset+size])
+    def readbytes(input, offset, length):
+        return input[offset:offset+length]
 except ImportError:
     import struct
     def runpack(fmt, input):
         return struct.unpack(fmt, input)[0]
+    def runpack_from(fmt, input, offset, size):
+        return struct.unpack_from(fmt, input, offset)[0]
+    def readbytes(input, offset, length):
+        return struct.unpack_from('%ds' % length, input, offset)[0]
 
 class LuaParseError(Exception):
     def __init__(self, message):
@@ -16,6 +30,14 @@ class LuaParseError(Exception):
 class LuaObject:
     pass
 
+class LuaNil(LuaObject):
+    def __init__(self):
+        self.value = None
+
+class LuaBoolean(LuaObject):
+    def __init__(self, value):
+        self.value = value
+
 class LuaNumber(LuaObject):
     def __init__(self, value):
         self.value = value
@@ -74,12 +96,26 @@ class LuaFunction:
     is_vararg_flag, 1 byte, 1 = VARARG_HASARG, 2 = VARARG_ISVARARG,
         4 = VARARG_NEEDSARG
     max_stack_size: 1 byte, number of registers used
-    instructions: list of instructions (each one a 4-byte string)
+    instructions: list of instructions, each one decoded to an unsigned int
     constants: list of constants
-    prototypes: list of inner functions of LuaFunction type
+    prototypes: list of inner functions of LuaFunction type, or None for
+        those not parsed yet when loaded lazily (see get_prototype)
     inst_positions: list of source line positions (optional debug data)
     locvars: list of local variables (optional debug data)
     upvalues: list of upvalues (optional debug data)
+
+    The three debug data lists are left empty when loaded without debug
+    info, in which case debug_offset is where that data starts.
+
+    compiled is the Python function the interpreter's compiled tier made
+    from this function, once it has been run that way (see codegen.py).
+    quick_counts and quickened are the interpreter's run counts and
+    specialized versions of its instructions (see quicken.py), and
+    global_versions and global_slots its cache of where the globals
+    GETGLOBAL and SETGLOBAL use are (see Interpreter.global_cache),
+    table_shapes, table_slots and table_next_shapes the same for the
+    fields of tables (see Interpreter.table_cache), and index_cache for
+    what tables inherit through __index (see Interpreter.index_cache).
     """
     def __init__(self, sourcename, line_defined, last_line_defined,
                  num_upvalues, num_parameters, is_vararg_flag, max_stack_size,
@@ -98,31 +134,110 @@ class LuaFunction:
         self.inst_positions = inst_positions
         self.locvars = locvars
         self.upvalues = upvalues
+        # set when loaded lazily: where each unparsed prototype starts,
+        # and how many upvalues it has
+        self.prototype_offsets = []
+        self.prototype_upvalues = []
+        # set when loaded without debug info: where it starts
+        self.debug_offset = -1
+        # the LuaBytecode to parse either of the above from
+        self.loader = None
+        self.line_info = None
+        self.compiled = None
+        # whether the interpreter has turned pairs of instructions into
+        # superinstructions (see superinst.py)
+        self.fused = False
+        self.quick_counts = None
+        self.quickened = None
+        self.global_versions = None
+        self.global_slots = None
+        self.table_shapes = None
+        self.table_slots = None
+        self.table_next_shapes = None
+        self.index_cache = None
+
+    def get_prototype(self, index):
+        """ Returns the inner function at index, parsing it first if it
+        was skipped over by a lazy load and has not been used yet.
+        """
+        prototype = self.prototypes[index]
+        if prototype is None:
+            prototype = self.loader.parse_prototype(
+                self.prototype_offsets[index])
+            self.prototypes[index] = prototype
+        return prototype
+
+    def get_num_upvalues(self, index):
+        """ Returns the number of upvalues of the inner function at index,
+        without parsing it if it was skipped over by a lazy load.
+        """
+        prototype = self.prototypes[index]
+        if prototype is None:
+            return self.prototype_upvalues[index]
+        return prototype.num_upvalues
+
+    def get_line_info(self):
+        """ Returns the source line of each instruction as an array('i'),
+        decoding it from the bytecode the first time if it was loaded
+        without debug info.
+        """
+        if self.line_info is None:
+            if self.debug_offset >= 0:
+                self.line_info = self.loader.parse_line_info(self.debug_offset)
+            else:
+                self.line_info = array('i', [line for (_, line)
+                                             in self.inst_positions])
+        return self.line_info
+
+    def get_line(self, pc):
+        """ Returns the source line of the instruction at pc, or 0 if the
+        chunk has no line positions (e.g. it was stripped by luac -s).
+        """
+        line_info = self.get_line_info()
+        return line_info[pc] if 0 <= pc < len(line_info) else 0
 
     def as_str(self):
         return 'LuaFunction@%d:%d' % (self.line_defined, self.last_line_defined)
 
 class LuaBytecode:
-    """ Reads a bytestring of an object compiled with luac and parses
-    it, organizing its data into fields of this object.
+    """ Reads an object compiled with luac and parses it, organizing
+    its data into fields of this object.  The bytecode can be a string,
+    or an mmap or memoryview over it, in which case it is read in place
+    and only constants and names are copied out of it.
+
+    If lazy is true, inner functions are only scanned over to find where
+    they start, and each one is parsed the first time it is requested
+    with LuaFunction.get_prototype.
+
+    If debug_info is false, the source line positions, locals and upvalue
+    names of each function are skipped over, and line positions are only
+    decoded when LuaFunction.get_line_info asks for them.
+
+    In either case the bytecode is kept, and must stay valid for as long
+    as the parsed functions are in use.
     """
-    def __init__(self, bytecode):
+    def __init__(self, bytecode, lazy=False, debug_info=True):
+        self.lazy = lazy
+        self.debug_info = debug_info
+        self.bytecode = bytecode if lazy or not debug_info else None
         # Parse header.
-        signature = bytecode[:4]
+        if len(bytecode) < 12:
+            raise LuaParseError('bytecode is too short to hold a header')
+        signature = readbytes(bytecode, 0, 4)
         if signature != '\x1b\x4c\x75\x61':
             raise LuaParseError('signature of bytecode file is invalid')
-        version = ord(bytecode[4])
+        version = self.unpack_byte(bytecode, 4)
         if version != 81:
             raise LuaParseError('invalid version, must be 0x51 (dec 81)')
-        format_version = ord(bytecode[5])
+        format_version = self.unpack_byte(bytecode, 5)
         if format_version != 0:
             raise LuaParseError('format version is not official')
-        endianness = ord(bytecode[6])
-        size_of_int = ord(bytecode[7])
-        size_of_size_t = ord(bytecode[8])
-        size_of_instruction = ord(bytecode[9])
-        size_of_lua_Number = ord(bytecode[10])
-        integral_flag = ord(bytecode[11])
+        endianness = self.unpack_byte(bytecode, 6)
+        size_of_int = self.unpack_byte(bytecode, 7)
+        size_of_size_t = self.unpack_byte(bytecode, 8)
+        size_of_instruction = self.unpack_byte(bytecode, 9)
+        size_of_lua_Number = self.unpack_byte(bytecode, 10)
+        integral_flag = self.unpack_byte(bytecode, 11)
         self.header = LuaHeader(signature, version, format_version, endianness,
                                 size_of_int, size_of_size_t,
                                 size_of_instruction, size_of_lua_Number,
@@ -139,48 +254,58 @@ class LuaBytecode:
             (i, len(bytecode))
 
     # These unpack functions are written the way they are because
-    # runpack's first argument must be a constant.
-    def unpack_sizet(self, input):
+    # runpack's first argument must be a constant.  Each one reads the
+    # field starting at offset i of the bytecode.
+    def unpack_byte(self, bytecode, i):
+        return runpack_from('B', bytecode, i, 1)
+
+    def unpack_sizet(self, bytecode, i):
         if self.header.size_of_size_t == 4:
-            return runpack('i', input)
+            return runpack_from('i', bytecode, i, 4)
         else:
-            return runpack('l', input)
+            return runpack_from('l', bytecode, i, 8)
 
-    def unpack_int(self, input):
+    def unpack_int(self, bytecode, i):
         if self.header.endianness == 0:
             if self.header.size_of_int == 4:
-                return runpack('>i', input)
+                return runpack_from('>i', bytecode, i, 4)
             else:
-                return runpack('>l', input)
+                return runpack_from('>l', bytecode, i, 8)
         else:
             if self.header.size_of_int == 4:
-                return runpack('<i', input)
+                return runpack_from('<i', bytecode, i, 4)
             else:
-                return runpack('<l', input)
+                return runpack_from('<l', bytecode, i, 8)
+
+    def unpack_instruction(self, bytecode, i):
+        if self.header.endianness == 0:
+            return runpack_from('>I', bytecode, i, 4)
+        else:
+            return runpack_from('<I', bytecode, i, 4)
 
-    def unpack_number(self, input):
+    def unpack_number(self, bytecode, i):
         if self.header.endianness == 0:
             if self.header.integral_flag == 1:
                 if self.header.size_of_lua_Number == 4:
-                    return runpack('>i', input)
+                    return runpack_from('>i', bytecode, i, 4)
                 else:
-                    return runpack('>l', input)
+                    return runpack_from('>l', bytecode, i, 8)
             else:
                 if self.header.size_of_lua_Number == 4:
-                    return runpack('>f', input)
+                    return runpack_from('>f', bytecode, i, 4)
                 else:
-                    return runpack('>d', input)
+                    return runpack_from('>d', bytecode, i, 8)
         else:
             if self.header.integral_flag == 1:
                 if self.header.size_of_lua_Number == 4:
-                    return runpack('<i', input)
+                    return runpack_from('<i', bytecode, i, 4)
                 else:
-                    return runpack('<l', input)
+                    return runpack_from('<l', bytecode, i, 8)
             else:
                 if self.header.size_of_lua_Number == 4:
-                    return runpack('<f', input)
+                    return runpack_from('<f', bytecode, i, 4)
                 else:
-                    return runpack('<d', input)
+                    return runpack_from('<d', bytecode, i, 8)
 
     def parse_function(self, bytecode, i):
         """ Parses a function as well as all function prototypes it contains.
@@ -197,134 +322,328 @@ class LuaBytecode:
         sizeof_inst = self.header.size_of_instruction
         sizeof_ln = self.header.size_of_lua_Number
 
-        sourcename_size = self.unpack_sizet(bytecode[i:i+sizeof_sizet])
+        sourcename_size = self.unpack_sizet(bytecode, i)
         i += sizeof_sizet
         sourcename = ''
         if sourcename_size > 0:
             sourcename_size_idx = max(0, sourcename_size - 1)
-            sourcename = bytecode[i:i+sourcename_size_idx]
+            sourcename = readbytes(bytecode, i, sourcename_size_idx)
             i += sourcename_size
 
-        line_defined = self.unpack_int(bytecode[i:i+sizeof_int])
+        line_defined = self.unpack_int(bytecode, i)
         i += sizeof_int
-        last_line_defined = self.unpack_int(bytecode[i:i+sizeof_int])
+        last_line_defined = self.unpack_int(bytecode, i)
         i += sizeof_int
-        num_upvalues = ord(bytecode[i])
+        num_upvalues = self.unpack_byte(bytecode, i)
         i += 1
-        num_parameters = ord(bytecode[i])
+        num_parameters = self.unpack_byte(bytecode, i)
         i += 1
-        is_vararg_flag = ord(bytecode[i])
+        is_vararg_flag = self.unpack_byte(bytecode, i)
         i += 1
-        max_stack_size = ord(bytecode[i])
+        max_stack_size = self.unpack_byte(bytecode, i)
         i += 1
 
-        # list of instructions
-        num_instructions = self.unpack_int(bytecode[i:i+sizeof_int])
+        # list of instructions, decoded once here so the interpreter
+        # never has to unpack them while running
+        num_instructions = self.unpack_int(bytecode, i)
         i += sizeof_int
         instructions = []
         for _ in xrange(num_instructions):
-            inst = bytecode[i:i+sizeof_inst]
+            inst = self.unpack_instruction(bytecode, i)
             i += sizeof_inst
             instructions.append(inst)
         
         # list of constants
-        sizek = self.unpack_int(bytecode[i:i+sizeof_int])
+        sizek = self.unpack_int(bytecode, i)
         i += sizeof_int
         constants = []
         for _ in xrange(sizek):
-            constant_type = ord(bytecode[i])
+            constant_type = self.unpack_byte(bytecode, i)
             i += 1
             if constant_type == 0: # nil
-                pass
+                constants.append(LuaNil())
             elif constant_type == 1: # boolean
-                pass
+                value = self.unpack_byte(bytecode, i)
+                i += 1
+                constants.append(LuaBoolean(value != 0))
             elif constant_type == 3: # number
-                value = self.unpack_number(bytecode[i:i+sizeof_ln])
+                value = self.unpack_number(bytecode, i)
                 i += sizeof_ln
                 luavalue = LuaNumber(value)
                 constants.append(luavalue)
             elif constant_type == 4: # string
-                value_length = self.unpack_sizet(bytecode[i:i+sizeof_sizet])
+                value_length = self.unpack_sizet(bytecode, i)
                 i += sizeof_sizet
                 value = ''
                 if value_length > 0:
                     value_length_idx = max(0, value_length - 1)
-                    value = bytecode[i:i+value_length_idx]
+                    value = readbytes(bytecode, i, value_length_idx)
                     i += value_length
                 luavalue = LuaString(value)
                 constants.append(luavalue)
 
         # list of function prototypes
-        sizep = self.unpack_int(bytecode[i:i+sizeof_int])
+        sizep = self.unpack_int(bytecode, i)
         i += sizeof_int
         prototypes = []
+        prototype_offsets = []
+        prototype_upvalues = []
         for _ in xrange(sizep):
-            prototype, new_i = self.parse_function(bytecode, i)
-            prototypes.append(prototype)
-            i = new_i
+            if self.lazy:
+                prototypes.append(None)
+                prototype_offsets.append(i)
+                # num_upvalues follows the source name and the two lines
+                j = i + sizeof_sizet + self.unpack_sizet(bytecode, i)
+                prototype_upvalues.append(
+                    self.unpack_byte(bytecode, j + 2 * sizeof_int))
+                i = self.skip_function(bytecode, i)
+            else:
+                prototype, new_i = self.parse_function(bytecode, i)
+                prototypes.append(prototype)
+                i = new_i
 
         # debugging info
-        # source line position list
-        sizelineinfo = self.unpack_int(bytecode[i:i+sizeof_int])
-        i += sizeof_int
         inst_positions = []
-        for j in xrange(sizelineinfo):
-            inst_positions.append((j, self.unpack_int(bytecode[i:i+sizeof_int])))
-            i += sizeof_int
-
-        # local list
-        sizelocvars = self.unpack_int(bytecode[i:i+sizeof_int])
-        i += sizeof_int
         locvars = []
-        for _ in xrange(sizelocvars):
-            varname_length = self.unpack_sizet(bytecode[i:i+sizeof_sizet])
-            i += sizeof_sizet
-            varname = ''
-            if varname_length > 0:
-                varname_length_idx = max(0, varname_length - 1)
-                varname = bytecode[i:i+varname_length_idx]
-                i += varname_length
-            startpc = self.unpack_int(bytecode[i:i+sizeof_int])
+        upvalues = []
+        debug_offset = -1
+        if not self.debug_info:
+            # only remember where it starts, see LuaFunction.get_line_info
+            debug_offset = i
+            i = self.skip_debug_info(bytecode, i)
+        else:
+            # source line position list
+            sizelineinfo = self.unpack_int(bytecode, i)
             i += sizeof_int
-            endpc = self.unpack_int(bytecode[i:i+sizeof_int])
+            for j in xrange(sizelineinfo):
+                inst_positions.append((j, self.unpack_int(bytecode, i)))
+                i += sizeof_int
+
+            # local list
+            sizelocvars = self.unpack_int(bytecode, i)
             i += sizeof_int
-            locvars.append((varname, startpc, endpc))
+            for _ in xrange(sizelocvars):
+                varname_length = self.unpack_sizet(bytecode, i)
+                i += sizeof_sizet
+                varname = ''
+                if varname_length > 0:
+                    varname_length_idx = max(0, varname_length - 1)
+                    varname = readbytes(bytecode, i, varname_length_idx)
+                    i += varname_length
+                startpc = self.unpack_int(bytecode, i)
+                i += sizeof_int
+                endpc = self.unpack_int(bytecode, i)
+                i += sizeof_int
+                locvars.append((varname, startpc, endpc))
 
-        # upvalue list
-        sizeupvalues = self.unpack_int(bytecode[i:i+sizeof_int])
-        i += sizeof_int
-        upvalues = []
-        for _ in xrange(sizeupvalues):
-            upvalue_length = self.unpack_sizet(bytecode[i:i+sizeof_sizet])
-            i += sizeof_sizet
-            upvalue = ''
-            if upvalue_length > 0:
-                upvalue_length_idx = max(0, upvalue_length - 1)
-                upvalue = bytecode[i:i+upvalue_length_idx]
-                i += upvalue_length
-            upvalues.append(upvalue)
+            # upvalue list
+            sizeupvalues = self.unpack_int(bytecode, i)
+            i += sizeof_int
+            for _ in xrange(sizeupvalues):
+                upvalue_length = self.unpack_sizet(bytecode, i)
+                i += sizeof_sizet
+                upvalue = ''
+                if upvalue_length > 0:
+                    upvalue_length_idx = max(0, upvalue_length - 1)
+                    upvalue = readbytes(bytecode, i, upvalue_length_idx)
+                    i += upvalue_length
+                upvalues.append(upvalue)
 
         result = LuaFunction(sourcename, line_defined, last_line_defined,
                              num_upvalues, num_parameters, is_vararg_flag,
                              max_stack_size, instructions, constants,
                              prototypes, inst_positions, locvars, upvalues)
+        if self.lazy:
+            result.prototype_offsets = prototype_offsets
+            result.prototype_upvalues = prototype_upvalues
+        result.debug_offset = debug_offset
+        if self.bytecode is not None:
+            result.loader = self
         return result, i
 
-def entry_point(argv):
+    def parse_prototype(self, i):
+        """ Parses the function starting at index i of the bytecode kept
+        by a lazy load.
+        """
+        prototype, _ = self.parse_function(self.bytecode, i)
+        return prototype
+
+    def parse_line_info(self, i):
+        """ Decodes the source line position list starting at index i of
+        the bytecode kept by a load without debug info.
+
+        Returns: An array('i') holding the source line of each instruction
+        """
+        sizeof_int = self.header.size_of_int
+        bytecode = self.bytecode
+        sizelineinfo = self.unpack_int(bytecode, i)
+        i += sizeof_int
+        line_info = array('i')
+        for _ in xrange(sizelineinfo):
+            line_info.append(self.unpack_int(bytecode, i))
+            i += sizeof_int
+        return line_info
+
+    def skip_function(self, bytecode, i):
+        """ Scans over a function and all function prototypes it contains
+        without building any of it, reading only the sizes needed to
+        find where it ends.
+
+        Parameters:
+            bytecode - The bytecode object being parsed
+            i - bytecode index to start at
+
+        Returns: The index the function ended at
+        """
+        sizeof_int = self.header.size_of_int
+        sizeof_sizet = self.header.size_of_size_t
+        sizeof_inst = self.header.size_of_instruction
+        sizeof_ln = self.header.size_of_lua_Number
+
+        # source name, line defined, last line defined, and the four
+        # single byte fields
+        i += sizeof_sizet + self.unpack_sizet(bytecode, i)
+        i += 2 * sizeof_int + 4
+        # instructions
+        i += sizeof_int + self.unpack_int(bytecode, i) * sizeof_inst
+        # constants
+        sizek = self.unpack_int(bytecode, i)
+        i += sizeof_int
+        for _ in xrange(sizek):
+            constant_type = self.unpack_byte(bytecode, i)
+            i += 1
+            if constant_type == 1: # boolean
+                i += 1
+            elif constant_type == 3: # number
+                i += sizeof_ln
+            elif constant_type == 4: # string
+                i += sizeof_sizet + self.unpack_sizet(bytecode, i)
+        # function prototypes
+        sizep = self.unpack_int(bytecode, i)
+        i += sizeof_int
+        for _ in xrange(sizep):
+            i = self.skip_function(bytecode, i)
+        return self.skip_debug_info(bytecode, i)
+
+    def skip_debug_info(self, bytecode, i):
+        """ Scans over the debug info at the end of a function: its
+        source line positions, locals and upvalue names.
+
+        Returns: The index the debug info ended at
+        """
+        sizeof_int = self.header.size_of_int
+        sizeof_sizet = self.header.size_of_size_t
+        # source line positions
+        i += sizeof_int + self.unpack_int(bytecode, i) * sizeof_int
+        # locals
+        sizelocvars = self.unpack_int(bytecode, i)
+        i += sizeof_int
+        for _ in xrange(sizelocvars):
+            i += sizeof_sizet + self.unpack_sizet(bytecode, i)
+            i += 2 * sizeof_int
+        # upvalues
+        sizeupvalues = self.unpack_int(bytecode, i)
+        i += sizeof_int
+        for _ in xrange(sizeupvalues):
+            i += sizeof_sizet + self.unpack_sizet(bytecode, i)
+        return i
+
+def read_fd(fd):
+    """ Reads everything left in the file descriptor fd.  A regular file
+    is read with a single read of its size, anything else (e.g. a pipe
+    on stdin) in blocks that are joined once at the end, so either way
+    the time taken is linear in the size.
+    """
     import os
+    size = os.fstat(fd).st_size
+    blocks = []
+    if size > 0:
+        block = os.read(fd, size)
+        blocks.append(block)
+    while True:
+        block = os.read(fd, 65536)
+        if len(block) == 0:
+            break
+        blocks.append(block)
+    if len(blocks) == 1:
+        return blocks[0]
+    return ''.join(blocks)
+
+def read_file(filename):
+    """ Reads the whole file at filename, or stdin if filename is '-'. """
+    import os
+    if filename == '-':
+        return read_fd(0)
+    fd = os.open(filename, os.O_RDONLY, 0777)
+    try:
+        return read_fd(fd)
+    finally:
+        os.close(fd)
+
+def load_buffer(buffer, lazy=False, debug_info=True):
+    """ Parses bytecode handed over in memory, e.g. by a program embedding
+    the interpreter.  The buffer can be a string, or anything with the
+    buffer interface (mmap, bytearray, memoryview), which is read in place
+    without copying it.
+    """
+    return LuaBytecode(buffer, lazy, debug_info)
+
+def load_file(filename, lazy=False, debug_info=True):
+    """ Parses the luac file at filename, or the bytecode on stdin if
+    filename is '-'.  Files that can be mapped into memory are parsed in
+    place through parse_mmap, and anything else is read in one go.
+    """
+    if filename != '-':
+        import mmap
+        try:
+            return parse_mmap(filename, lazy, debug_info)
+        except (mmap.error, ValueError):
+            # e.g. an empty file, or a pipe or device that can't be mapped
+            pass
+    return load_buffer(read_file(filename), lazy, debug_info)
+
+def parse_mmap(filename, lazy=False, debug_info=True):
+    """ Parses the luac file at filename by mapping it into memory and
+    reading it in place, rather than reading a copy of the whole file
+    into a string first.  The mapping is left open if the LuaBytecode
+    keeps it to parse more of it later (see LuaBytecode).
+    """
+    import mmap
+    f = open(filename, 'rb')
+    try:
+        bytecode = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        lua_bytecode = None
+        try:
+            lua_bytecode = LuaBytecode(bytecode, lazy, debug_info)
+        finally:
+            if lua_bytecode is None or lua_bytecode.bytecode is None:
+                bytecode.close()
+        return lua_bytecode
+    finally:
+        f.close()
+
+def compile_lua(filename):
+    """ Compiles the lua script at filename with luac, writing the
+    bytecode next to it with a .luac extension.
+
+    Returns: The bytecode as a string
+    """
+    import subprocess
+    luac_filename = filename + 'c'
+    if subprocess.call(['luac', '-o', luac_filename, filename]) != 0:
+        raise LuaParseError('luac failed to compile ' + filename)
+    f = open(luac_filename, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def entry_point(argv):
     if len(argv) != 2:
         print 'usage: parser.py lua-file'
         raise AssertionError()
-    filename = argv[1] # must be luac-generated file
-    bcfile = os.open(filename, os.O_RDONLY, 0777)
-    bytecode = ""
-    while True:
-        read = os.read(bcfile, 4096)
-        if len(read) == 0:
-            break
-        bytecode += read
-    os.close(bcfile)
-    lua_bytecode = LuaBytecode(bytecode)
+    filename = argv[1] # must be luac-generated file, or - for stdin
+    lua_bytecode = LuaBytecode(read_file(filename))
     print '=== header ==='
     print lua_bytecode.header.as_str()
     return 0
@@ -0,0 +1,116 @@
+# quicken: type-specializing quickening of arithmetic and compare
+# instructions.
+#
+# The interpreter counts how many times each of these instructions runs.
+# When one reaches QUICKEN_THRESHOLD, it is rewritten in place to the
+# internal opcode QUICK, and a Python function specialized for the types
+# its operands have at that point, with its operands decoded and any
+# constant operand already looked up, is kept on the LuaFunction for its
+# pc.  If the operands later turn out to have other types, the function
+# puts the instruction back the way it was, which then runs
+# QUICKEN_BACKOFF more times before it is quickened again.
+
+from opcodes import *
+import superinst
+
+QUICK = superinst.FORLOOP_BODY + 1
+assert QUICK <= 0x0000003f
+
+QUICKEN_THRESHOLD = 8
+QUICKEN_BACKOFF = 1024
+
+# operand types worth specializing for
+NUMBER_TYPES = (float, int, long)
+
+ARITH_OPERATORS = {ADD: '+', SUB: '-', MUL: '*', DIV: '/', MOD: '%',
+                   POW: '**'}
+COMPARE_OPERATORS = {EQ: '==', LT: '<', LE: '<='}
+QUICKENED = ARITH_OPERATORS.keys() + COMPARE_OPERATORS.keys()
+
+# Both templates take the interpreter, the decoded operands, the types
+# of rk(b) and rk(c) to guard on, and the function to call when the
+# guard fails.  A constant operand is passed as its value instead of
+# its index, and is read as is.
+ARITH_TEMPLATE = '''
+def make(interp, a, b, c, tb, tc, deopt):
+    def run():
+        S = interp.stack
+        base = interp.base
+        x = %(x)s
+        y = %(y)s
+        if type(x) is tb and type(y) is tc:
+            S[base+a] = x %(op)s y
+        else:
+            deopt()
+    return run
+'''
+
+COMPARE_TEMPLATE = '''
+def make(interp, a, b, c, tb, tc, deopt):
+    def run():
+        S = interp.stack
+        base = interp.base
+        x = %(x)s
+        y = %(y)s
+        if type(x) is tb and type(y) is tc:
+            if (x %(op)s y) != a:
+                interp.pc += 1
+        else:
+            deopt()
+    return run
+'''
+
+def make_factories():
+    """ Compiles the templates into a dict of factories, keyed by opcode
+    and whether b and c are constants.
+    """
+    factories = {}
+    for opcode in QUICKENED:
+        if opcode in ARITH_OPERATORS:
+            template = ARITH_TEMPLATE
+            op = ARITH_OPERATORS[opcode]
+        else:
+            template = COMPARE_TEMPLATE
+            op = COMPARE_OPERATORS[opcode]
+        for b_is_k in (False, True):
+            for c_is_k in (False, True):
+                source = template % {
+                    'x': 'b' if b_is_k else 'S[base+b]',
+                    'y': 'c' if c_is_k else 'S[base+c]',
+                    'op': op}
+                namespace = {}
+                exec source in namespace
+                factories[(opcode, b_is_k, c_is_k)] = namespace['make']
+    return factories
+
+FACTORIES = make_factories()
+
+def quicken(interp, function, pc, inst):
+    """ Rewrites the instruction inst at pc in function to QUICK, with a
+    version specialized for the types of its operands, unless they are
+    not numbers, in which case it is left for another QUICKEN_BACKOFF
+    runs.
+    """
+    opcode = inst & 0x0000003f
+    a, b, c = interp.getabc(inst)
+    x = interp.rk(b)
+    y = interp.rk(c)
+    if type(x) not in NUMBER_TYPES or type(y) not in NUMBER_TYPES:
+        function.quick_counts[pc] = -QUICKEN_BACKOFF
+        return
+    b_is_k = bool(b & 256)
+    c_is_k = bool(c & 256)
+    if b_is_k:
+        b = function.constants[b - 256].value
+    if c_is_k:
+        c = function.constants[c - 256].value
+    def deopt():
+        del function.quickened[pc]
+        function.instructions[pc] = inst
+        function.quick_counts[pc] = -QUICKEN_BACKOFF
+        interp.op_functions[opcode](inst)
+    make = FACTORIES[(opcode, b_is_k, c_is_k)]
+    if function.quickened is None:
+        function.quickened = {}
+    function.quickened[pc] = make(interp, a, b, c, type(x), type(y), deopt)
+    function.instructions[pc] = (inst & ~0x0000003f) | QUICK
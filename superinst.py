@@ -0,0 +1,107 @@
+# superinst: fuses common pairs of instructions into superinstructions,
+# which the interpreter runs with a single dispatch.
+#
+# A superinstruction replaces the first instruction of a pair, keeping
+# its operands and changing only its opcode to one of the internal ones
+# below.  The second instruction is left where it is, so jumps to it
+# still work, and the handler of the superinstruction reads it from the
+# next pc when it needs it.
+
+from opcodes import *
+
+# opcodes whose handlers never change pc or the frame.  Each has a fused
+# form (see Interpreter.fused_straight) that runs it and goes straight on
+# to the next instruction without going back to the main loop.  LOADNIL
+# is left out, as it rarely runs in loops, to leave an opcode free for
+# quicken.py.
+STRAIGHT = [MOVE, LOADK, GETUPVAL, GETGLOBAL, GETTABLE, SETGLOBAL, SETUPVAL,
+            SETTABLE, NEWTABLE, SELF, ADD, SUB, MUL, DIV, MOD, POW, UNM, NOT,
+            LEN, CONCAT]
+FUSED_STRAIGHT_FIRST = NUM_OPCODES
+FUSED_STRAIGHT_LAST = NUM_OPCODES + len(STRAIGHT) - 1
+
+# compare or test followed by the JMP it guards, and FORLOOP followed by
+# the first instruction of its body when it loops
+(EQ_JMP, LT_JMP, LE_JMP, TEST_JMP, FORLOOP_BODY) = \
+    range(FUSED_STRAIGHT_LAST + 1, FUSED_STRAIGHT_LAST + 6)
+assert FORLOOP_BODY <= 0x0000003f
+
+# the lua opcode each internal opcode stands for, in internal opcode order
+UNFUSED = STRAIGHT + [EQ, LT, LE, TEST, FORLOOP]
+
+# the pairs fused by --fuse, which are the pairs of instructions found
+# to run one after the other most often in the test scripts (measured
+# with `python benchmark.py pairs`).  (FORLOOP, None) stands for FORLOOP
+# and whatever its loop body starts with.
+DEFAULT_PAIRS = [
+    (SUB, CALL), (ADD, SETGLOBAL), (GETGLOBAL, ADD), (GETGLOBAL, SUB),
+    (SETGLOBAL, LT), (LT, JMP), (LE, JMP), (EQ, JMP), (TEST, JMP),
+    (ADD, RETURN), (GETGLOBAL, GETTABLE), (GETGLOBAL, CALL), (MOVE, MOVE),
+    (MOVE, CALL), (GETTABLE, LOADK), (GETTABLE, GETTABLE), (ADD, JMP),
+    (GETTABLE, GETGLOBAL), (LOADK, MOVE), (FORLOOP, None),
+    ]
+
+def fused_opcode(first, second):
+    """ Returns the internal opcode that fuses an instruction with opcode
+    first and the one after it with opcode second, or None if they
+    can't be fused.
+    """
+    if first in STRAIGHT:
+        return FUSED_STRAIGHT_FIRST + STRAIGHT.index(first)
+    if second == JMP:
+        if first == EQ:
+            return EQ_JMP
+        elif first == LT:
+            return LT_JMP
+        elif first == LE:
+            return LE_JMP
+        elif first == TEST:
+            return TEST_JMP
+    if first == FORLOOP:
+        return FORLOOP_BODY
+    return None
+
+def unfuse(inst):
+    """ Returns inst with the lua opcode a superinstruction stands for. """
+    opcode = inst & 0x0000003f
+    if opcode < NUM_OPCODES:
+        return inst
+    return (inst & ~0x0000003f) | UNFUSED[opcode - NUM_OPCODES]
+
+def fuse_function(function, pairs):
+    """ Rewrites the instructions of function in place, turning the first
+    instruction of each pair of opcodes in pairs into a superinstruction.
+    Pairs don't overlap, so the second instruction of a pair is never
+    the first of another one.
+    """
+    if function.fused:
+        return
+    pairs = set(pairs)
+    instructions = function.instructions
+    n = len(instructions)
+    pc = 0
+    while pc < n:
+        inst = instructions[pc]
+        opcode = inst & 0x0000003f
+        next_pc = pc + 1
+        if opcode == CLOSURE:
+            # skip the pseudo instructions that set up its upvalues
+            bx = (inst >> 14) & 0x0003ffff
+            next_pc += function.get_num_upvalues(bx)
+        elif opcode == SETLIST:
+            # skip the word holding c, if there is one
+            if (inst >> 14) & 0x000001ff == 0:
+                next_pc += 1
+        elif opcode == FORLOOP:
+            if (FORLOOP, None) in pairs:
+                instructions[pc] = (inst & ~0x0000003f) | FORLOOP_BODY
+        elif pc + 1 < n:
+            second = instructions[pc+1] & 0x0000003f
+            if (opcode, second) in pairs:
+                fused = fused_opcode(opcode, second)
+                if fused is not None:
+                    instructions[pc] = (inst & ~0x0000003f) | fused
+                    if second not in (CLOSURE, SETLIST):
+                        next_pc += 1
+        pc = next_pc
+    function.fused = True
@@ -0,0 +1,29 @@
+-- an integer key must live in only one part of a table, or pairs sees
+-- it twice, or never ends
+
+local function count(t)
+  local n = 0
+  for k, v in pairs(t) do
+    n = n + 1
+    if n > 100 then
+      -- pairs does not end
+      break
+    end
+  end
+  return n
+end
+
+local t = {}
+for i = 1, 5 do t[i] = i end
+t[8] = 8
+t[9] = "old"
+for i = 1, 6 do t[-i] = -i end
+t[9] = "new"
+print(t[9], count(t))
+local nines = 0
+for k, v in pairs(t) do
+  if k == 9 then nines = nines + 1 end
+end
+print(nines)
+t[9] = nil
+print(t[9], count(t))